@@ -1,19 +1,48 @@
 import inspect
 import time
+import os
+import atexit
+import threading
+import Queue
+
+# log levels
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+levelNames = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+levelValues = dict((name, level) for (level, name) in levelNames.items())
+
+class BTHex(object):
+    """ A string of bytes that is formatted as hex when it is logged."""
+    __slots__ = ["data"]
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return self.data.encode("hex")
 
 class BTObject(object):
     def __init__(self, theName, theApp):
         self.name = theName
         self.app = theApp
-        if self.app.debugObject: self.app.log(self.name, "created")
+        if self.app.debugObject: self.app.logDebug(self.name, "created")
 
 class BTApp(object):
     def __init__(self, configFileName, logFileName, config):
         self.running = True         # True until something terminates the program
         self.configFileName = configFileName
         self.logFileName = logFileName
+        # logging defaults
+        self.logLevel = "DEBUG"         # lowest level written
+        self.logCategories = {}         # lowest level written for specific categories
+        self.logQueueSize = 10000       # records waiting to be written before new ones are dropped
+        self.logMaxBytes = 0            # size the log file is rotated at, 0 to never rotate
+        self.logBackups = 3             # number of rotated log files kept
         self.setConfig(config)
         self.readConfig()
+        self.startLog()
 
     def setConfig(self, config, override=True):
         for item in config.keys():
@@ -42,11 +71,138 @@ class BTApp(object):
         except:
             pass
     
+    def startLog(self):
+        self.minLevel = levelValues[self.logLevel]
+        self.categoryLevels = dict((category, levelValues[level]) for (category, level) in self.logCategories.items())
+        self.logger = BTLogger(self.logFileName, self.logQueueSize, self.logMaxBytes, self.logBackups)
+        self.logger.start()
+        atexit.register(self.logger.stop)
+
     def log(self, *args):
+        self.logLevelMsg(INFO, *args)
+
+    def logDebug(self, *args):
+        self.logLevelMsg(DEBUG, *args)
+
+    def logWarning(self, *args):
+        self.logLevelMsg(WARNING, *args)
+
+    def logError(self, *args):
+        self.logLevelMsg(ERROR, *args)
+
+    def logLevelMsg(self, level, *args):
+        # queue the message to be written if its level and category are enabled
+        # the arguments are not formatted until the message is written
+        if level < self.categoryLevels.get(args[0], self.minLevel):
+            return
+        self.logger.put((time.time(), level, args))
+
+    # wrap a string of bytes so it is formatted as hex when it is logged
+    hex = BTHex
+
+class BTContext(BTApp):
+    """ Configuration of one part of an application, such as one of several pools.
+
+    The values in its configuration file override the application's, and every
+    other value, including the log and the running flag, is the application's.
+    Log messages are prefixed with the name of the context."""
+    def __init__(self, theName, theApp, configFileName, config={}):
+        self.app = theApp
+        self.name = theName
+        self.configFileName = configFileName
+        self.setConfig(config)
+        self.readConfig()
+
+    def __getattr__(self, name):
+        # only called for values that aren't set in the context
+        return getattr(self.app, name)
+
+    # stopping any part stops the application
+    running = property(lambda self: self.app.running, lambda self, value: setattr(self.app, "running", value))
+
+    def logLevelMsg(self, level, *args):
+        if level < self.categoryLevels.get(args[0], self.minLevel):
+            return
+        self.logger.put((time.time(), level, (self.name+" "+args[0],)+args[1:]))
+
+class BTLogger(threading.Thread):
+    """ Background log writer.
+
+    Messages are put on a bounded queue and written by this thread in batches to a
+    log file that stays open.  If the queue is full the message is dropped and
+    counted, so the caller never waits for the disk.
+    """
+    def __init__(self, fileName, queueSize, maxBytes, backups):
+        threading.Thread.__init__(self, target=self.writeLog, name="Log")
+        self.daemon = True
+        self.fileName = fileName
+        self.maxBytes = maxBytes
+        self.backups = backups
+        self.queue = Queue.Queue(queueSize)
+        self.drops = 0              # total number of messages dropped
+        self.reportedDrops = 0      # number of dropped messages reported in the log
+        self.stopped = False
+
+    def put(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.drops += 1
+
+    def stop(self):
+        # write the messages that are queued and stop
+        if self.isAlive() and not self.stopped:
+            self.stopped = True
+            self.queue.put(None)
+            self.join(5)
+
+    def writeLog(self):
+        logFile = open(self.fileName, "a")
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            # take everything else that is waiting
+            try:
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            lines = []
+            for record in batch:
+                if record is None:
+                    running = False
+                    continue
+                try:
+                    lines.append(self.format(record))
+                except Exception:
+                    # a record that can't be formatted must not stop the log
+                    (recordTime, level, args) = record
+                    args = tuple(arg if isinstance(arg, str) else repr(arg) for arg in args)
+                    lines.append(self.format((recordTime, level, args)))
+            if self.drops != self.reportedDrops:
+                lines.append(self.format((time.time(), WARNING, ("Log", self.drops - self.reportedDrops, "messages dropped"))))
+                self.reportedDrops = self.drops
+            logFile.write("".join(lines))
+            logFile.flush()
+            if self.maxBytes and (logFile.tell() >= self.maxBytes):
+                logFile.close()
+                self.rotate()
+                logFile = open(self.fileName, "a")
+        logFile.close()
+
+    def format(self, (recordTime, level, args)):
         message = "%-16s: "%args[0]
         for arg in args[1:]:
             message += arg.__str__()+" "
-        logFile = open(self.logFileName, "a")
-        logFile.write(time.strftime("%Y-%m-%d %H:%M:%S")+" - "+message+"\n")
-        logFile.close()
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(recordTime))+" - "+\
+               ("" if level == INFO else levelNames[level]+" ")+message+"\n"
 
+    def rotate(self):
+        # aqualink.log -> aqualink.log.1 -> aqualink.log.2 ...
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("%s.%d" % (self.fileName, i)):
+                os.rename("%s.%d" % (self.fileName, i), "%s.%d" % (self.fileName, i + 1))
+        if self.backups > 0:
+            os.rename(self.fileName, self.fileName+".1")
+        else:
+            os.remove(self.fileName)
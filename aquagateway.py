@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from aqualink.gateway import *
+from BTUtils import *
+
+########################################################################################################
+# main routine
+########################################################################################################
+
+if __name__ == "__main__":
+    app = BTApp("config.py", "aquagateway.log", {})
+    gateway = Gateway("Gateway", app)
+    try:
+        gateway.run()
+    except KeyboardInterrupt:
+        app.running = False
@@ -3,16 +3,66 @@
 
 import struct
 import time
+import calendar
 import threading
 
 from pool import *
 from panel import *
 
+########################################################################################################
+# panels with equipment LEDs
+########################################################################################################
+
+class LedPanel(Panel):
+    """
+    A panel with equipment buttons and LEDs
+
+    The equipment states are decoded from the LED status.  equipList associates the
+    pool equipment with the buttons that change it and their status masks, and is
+    set by the panel with setEquipment.
+    """
+    # constructor
+    def __init__(self, theName, theContext, thePool):
+        Panel.__init__(self, theName, theContext, thePool)
+        self.equipList = []
+        self.cmdTable[self.cmdStatus.code] = LedPanel.handleStatus
+
+    def setEquipment(self, theEquipList):
+        self.equipList = theEquipList
+        self.statusDecoder = StatusDecoder(self.equipList, self.cmdStatus.argLen)
+
+        # add equipment events to the event list
+        for equip in self.equipList:
+            self.events += [equip.event]
+
+    def getAction(self, poolEquip):
+        # return the action associated with the specified equipment
+        for equip in self.equipList:
+            if equip.equip == poolEquip:
+                return equip.action
+        return None
+
+    # status command
+    def handleStatus(self, args):
+        cmd = self.cmdStatus
+        status = self.statusDecoder.unpack(args)
+        if status != self.lastStatus:    # only process changed values
+            if self.context.debugStatus: self.context.logDebug(self.name, cmd.name, "%010x"%(status))
+            for (equip, oldState, newState) in self.statusDecoder.changes(status, self.lastStatus):
+                if self.context.debugStatus: self.context.logDebug(self.name, cmd.name, equip.equip.name, "state current", "%x"%oldState, "new", "%x"%newState)
+                # set the equipment state, another panel may already have set it from the same status
+                if equip.equip.state != newState:
+                    equip.equip.setState(newState)
+                # set the event
+                equip.event.set()
+            self.lastStatus = status
+        self.statusEvent.set()
+
 ########################################################################################################
 # All Button panel
 ########################################################################################################
 
-class AllButtonPanel(Panel):
+class AllButtonPanel(LedPanel):
     """ 
     Aqualink All Button Control Panel
 
@@ -53,7 +103,7 @@ class AllButtonPanel(Panel):
     """
     # constructor
     def __init__(self, theName, theContext, thePool):
-        Panel.__init__(self, theName, theContext, thePool)
+        LedPanel.__init__(self, theName, theContext, thePool)
 
         # addressing
         self.baseAddr = 0x08
@@ -86,10 +136,8 @@ class AllButtonPanel(Panel):
         self.btnEnter        = Button("enter", 0x1d)
 
         # command parsing
-        del(self.cmdTable[self.cmdStatus.code])
         del(self.cmdTable[self.cmdMsg.code])
-        self.cmdTable.update({self.cmdStatus.code: AllButtonPanel.handleStatus,
-                              self.cmdMsg.code: AllButtonPanel.handleMsg,
+        self.cmdTable.update({self.cmdMsg.code: AllButtonPanel.handleMsg,
                               self.cmdLongMsg.code: AllButtonPanel.handleLongMsg})
         self.firstMsg = True
 
@@ -97,23 +145,21 @@ class AllButtonPanel(Panel):
         self.msgEvent = threading.Event()
 
         # create the list of associations between equipment, button codes, and status masks.
-        self.equipList = [PanelEquip(self.pool.aux2, self.btnAux2, 0xc000000000),
-                          PanelEquip(self.pool.aux3, self.btnAux3, 0x3000000000),
-                          PanelEquip(self.pool.aux7, self.btnAux7, 0x0300000000),
-                          PanelEquip(self.pool.aux5, self.btnAux5, 0x00c0000000),
-                          PanelEquip(self.pool.pump, self.btnPump, 0x0030000000),
-                          PanelEquip(self.pool.spa, self.btnSpa, 0x000c000000),
-                          PanelEquip(self.pool.aux1, self.btnAux1, 0x0003000000),
-                          PanelEquip(self.pool.aux6, self.btnAux6, 0x0000c00000),
-                          PanelEquip(self.pool.aux4, self.btnAux4, 0x0000030000),
-                          PanelEquip(self.pool.heater, self.btnSpaHtr, 0x000000000f),
-                          PanelEquip(self.pool.heater, self.btnPoolHtr, 0x000000f000),
-                          PanelEquip(self.pool.heater, self.btnSolarHtr, 0x00000000f0)]
+        self.setEquipment([PanelEquip(self.pool.aux2, self.btnAux2, 0xc000000000),
+                           PanelEquip(self.pool.aux3, self.btnAux3, 0x3000000000),
+                           PanelEquip(self.pool.aux7, self.btnAux7, 0x0300000000),
+                           PanelEquip(self.pool.aux5, self.btnAux5, 0x00c0000000),
+                           PanelEquip(self.pool.pump, self.btnPump, 0x0030000000),
+                           PanelEquip(self.pool.spa, self.btnSpa, 0x000c000000),
+                           PanelEquip(self.pool.aux1, self.btnAux1, 0x0003000000),
+                           PanelEquip(self.pool.aux6, self.btnAux6, 0x0000c00000),
+                           PanelEquip(self.pool.aux4, self.btnAux4, 0x0000030000),
+                           PanelEquip(self.pool.heater, self.btnSpaHtr, 0x000000000f),
+                           PanelEquip(self.pool.heater, self.btnPoolHtr, 0x000000f000),
+                           PanelEquip(self.pool.heater, self.btnSolarHtr, 0x00000000f0)])
 
-        # add equipment events to the event list
+        # add the message event to the event list
         self.events += [self.msgEvent]
-        for equip in self.equipList:
-            self.events += [equip.event]
         
         # menu actions
         self.menuAction = Action(self.btnMenu, self.msgEvent)
@@ -124,74 +170,55 @@ class AllButtonPanel(Panel):
 
     def dupAction(self, nTimes):
         # create a sequence containing a right or left action duplicated n times
+        # if the controller repeats the arrow buttons the presses are sent in consecutive acks
         seq = []
         if nTimes != 0:
             action = self.rightAction if nTimes > 0 else self.leftAction
-            for i in range(0, abs(nTimes)):
-                seq += [action]
+            if self.context.clockRepeat:
+                seq += [[action] * abs(nTimes)]
+            else:
+                for i in range(0, abs(nTimes)):
+                    seq += [action]
         return seq
             
-    def adjustTime(self, timeDiff):
-        # create and execute a sequence that adjusts the time on the controller by the specified difference.
-        if self.context.debug: self.context.log(self.name)
-        seq = [self.menuAction] + self.dupAction(3) + [self.enterAction]+ [self.enterAction] +\
-               self.dupAction(timeDiff[0]) + [self.enterAction] +\
-               self.dupAction(timeDiff[1]) + [self.enterAction] +\
-               self.dupAction(timeDiff[2]) + [self.enterAction] +\
-               self.dupAction(timeDiff[3]) + [self.enterAction] +\
-               self.dupAction(timeDiff[4]) + [self.enterAction]
-        action = ActionThread("set time", self.context, seq, self)
-        action.start()
+    def adjustTime(self, poolTime):
+        # create and execute a sequence that sets the time on the controller from the specified
+        # controller time to the current time.
+        # returns the ActionFuture for the sequence, the number of presses and the predicted duration
+        planner = ClockPlanner(self.context.clockRepeat, self.context.clockPressTime, self.context.clockRepeatTime)
+        # plan to the time the sequence is expected to finish
+        steps = planner.plan(poolTime, time.localtime())
+        duration = planner.duration(steps)
+        newTime = time.localtime(time.time() + duration)
+        steps = planner.plan(poolTime, newTime)
+        presses = planner.presses(steps)
+        duration = planner.duration(steps)
+        if self.context.debug: self.context.logDebug(self.name, "set time to", time.asctime(newTime), "steps", steps,
+                                                     "presses", presses, "predicted", "%.1f"%duration, "seconds")
+        seq = [self.menuAction] + self.dupAction(3) + [self.enterAction]+ [self.enterAction]
+        for step in steps:
+            seq += self.dupAction(step) + [self.enterAction]
+        return (self.executor.submit("set time", seq, priorityLow), presses, duration)
 
     def menu(self):
-        if self.context.debug: self.context.log(self.name)
-        action = ActionThread("menu", self.context, [self.menuAction], self)
-        action.start()
+        if self.context.debug: self.context.logDebug(self.name)
+        return self.executor.submit("menu", [self.menuAction])
 
     def left(self):
-        if self.context.debug: self.context.log(self.name)
-        action = ActionThread("left", self.context, [self.leftAction], self)
-        action.start()
+        if self.context.debug: self.context.logDebug(self.name)
+        return self.executor.submit("left", [self.leftAction])
 
     def right(self):
-        if self.context.debug: self.context.log(self.name)
-        action = ActionThread("right", self.context, [self.rightAction], self)
-        action.start()
+        if self.context.debug: self.context.logDebug(self.name)
+        return self.executor.submit("right", [self.rightAction])
 
     def cancel(self):
-        if self.context.debug: self.context.log(self.name)
-        action = ActionThread("cancel", self.context, [self.cancelAction], self)
-        action.start()
+        if self.context.debug: self.context.logDebug(self.name)
+        return self.executor.submit("cancel", [self.cancelAction])
 
     def enter(self):
-        if self.context.debug: self.context.log(self.name)
-        action = ActionThread("enter", self.context, [self.enterAction], self)
-        action.start()
-
-    def getAction(self, poolEquip):
-        # return the action associated with the specified equipment
-        for equip in self.equipList:
-            if equip.equip == poolEquip:
-                return equip.action
-        return None
-                
-    # status command
-    def handleStatus(self, args):
-        cmd = self.cmdStatus
-        status = int(args.encode("hex"), 16)
-        if status != self.lastStatus:    # only process changed values
-            if self.context.debugStatus: self.context.log(self.name, cmd.name, "%010x"%(status))
-            for equip in self.equipList:
-                shift = min(filter(lambda s: (equip.mask >> s) & 1 != 0, xrange(8*cmd.argLen)))
-                newState = (status & equip.mask) >> shift
-                oldState = (self.lastStatus & equip.mask) >> shift
-                if newState != oldState:
-                    if self.context.debugStatus: self.context.log(self.name, cmd.name, equip.equip.name, "state current", "%x"%oldState, "new", "%x"%newState)
-                    # set the equipment state
-                    equip.equip.setState(newState)
-                    # set the event
-                    equip.event.set()
-            self.lastStatus = status
+        if self.context.debug: self.context.logDebug(self.name)
+        return self.executor.submit("enter", [self.enterAction])
 
     # message command
     def handleMsg(self, args):
@@ -207,7 +234,7 @@ class AllButtonPanel(Panel):
     def handleMessage(self, cmd, args):
         line = struct.unpack("!B", args[0])[0]
         msg = args[1:].strip(" ")
-        if self.context.debugMsg: self.context.log(self.name, cmd.name, line, args[1:])
+        if self.context.debugMsg: self.context.logDebug(self.name, cmd.name, line, args[1:])
         msgParts = msg.split()
         if line == 0:
             self.msgEvent.set()
@@ -247,4 +274,125 @@ class PanelEquip(object):
         self.mask = theMask
         self.event = threading.Event()
         self.action = Action(self.button, self.event)
+        # position and width of the state in the status
+        self.shift = 0
+        while not (self.mask >> self.shift) & 1:
+            self.shift += 1
+        self.stateMask = self.mask >> self.shift
+
+class ClockPlanner(object):
+    """
+    Clock adjustment planner
+
+    The controller clock is set one field at a time in the order year, month, day, hour,
+    minute.  The right and left buttons step a field up or down, and a field wraps around
+    at the ends of its range without changing the next field.  For each field the planner
+    picks the direction that takes the fewest presses.
+    """
+    # number of presses to get to the time setting menu and to enter each field
+    menuPresses = 6
+    fieldPresses = 1
+
+    def __init__(self, theRepeat, thePressTime, theRepeatTime):
+        self.repeat = theRepeat             # the controller repeats arrow buttons sent in consecutive acks
+        self.pressTime = thePressTime       # seconds for a press that waits for the controller
+        self.repeatTime = theRepeatTime     # seconds for a repeated press
+
+    def fields(self, theTime):
+        # return the clock field values of a time and the (first value, number of values) of each field
+        daysInMonth = calendar.monthrange(theTime.tm_year, theTime.tm_mon)[1]
+        return ([theTime.tm_year % 100, theTime.tm_mon, theTime.tm_mday, theTime.tm_hour, theTime.tm_min],
+                [(0, 100), (1, 12), (1, daysInMonth), (0, 24), (0, 60)])
+
+    def step(self, current, target, first, size):
+        # return the shortest number of presses from the current value to the target, negative for left
+        current = min(max(current, first), first + size - 1)
+        up = (target - current) % size
+        return up if up <= size - up else up - size
+
+    def plan(self, fromTime, toTime):
+        # return the number of presses for each field to change the clock from one time to another
+        (currentValues, ranges) = self.fields(fromTime)
+        (targetValues, ranges) = self.fields(toTime)
+        # the range of the day depends on the month being set
+        return [self.step(current, target, first, size)
+                for (current, target, (first, size)) in zip(currentValues, targetValues, ranges)]
+
+    def presses(self, steps):
+        # return the total number of presses of a plan
+        return self.menuPresses + sum(abs(step) + self.fieldPresses for step in steps)
+
+    def duration(self, steps):
+        # return the predicted number of seconds a plan takes
+        duration = self.pressTime * (self.menuPresses + len(steps) * self.fieldPresses)
+        for step in steps:
+            if step == 0:
+                continue
+            if self.repeat:
+                duration += self.pressTime + self.repeatTime * (abs(step) - 1)
+            else:
+                duration += self.pressTime * abs(step)
+        return duration
+
+class StatusDecoder(object):
+    """
+    LED status decoder
+
+    Decodes the equipment states from the status message.  The bits that changed from
+    the previous status are found with an XOR, and a table for each byte of the status
+    gives the equipment whose bits are in the changed bits of that byte, so only the
+    equipment whose state changed is visited.
+    """
+    def __init__(self, theEquipList, theLen):
+        self.equipList = theEquipList
+        self.len = theLen
+        self.unpacker = struct.Struct("!BI")
+        # for each byte of the status and each value of the changed bits in it, the equipment affected
+        # the values that affect the same equipment share one tuple to keep the tables small
+        self.byteTable = []
+        for byte in range(self.len):
+            shift = 8 * (self.len - 1 - byte)
+            table = []
+            equipSets = {}
+            for bits in range(256):
+                equipSet = tuple(equip for equip in self.equipList if (equip.mask >> shift) & bits)
+                table.append(equipSets.setdefault(equipSet, equipSet))
+            self.byteTable.append((shift, table))
+
+    def unpack(self, args):
+        # convert the status message arguments to an integer
+        if len(args) == 5:
+            (high, low) = self.unpacker.unpack(args)
+            return (high << 32) | low
+        return int(args.encode("hex"), 16)
+
+    def changes(self, status, lastStatus):
+        # return a list of (equipment, old state, new state) for the equipment whose state changed
+        changed = status ^ lastStatus
+        if not changed:
+            return []
+        equipChanged = ()
+        nBytes = 0
+        for (shift, table) in self.byteTable:
+            bits = (changed >> shift) & 0xff
+            if bits:
+                equipChanged += table[bits]
+                nBytes += 1
+        if nBytes > 1:
+            # keep the order of the equipment list, and list equipment that spans bytes once
+            equipChanged = [equip for equip in self.equipList if equip in equipChanged]
+        return [(equip, (lastStatus >> equip.shift) & equip.stateMask, (status >> equip.shift) & equip.stateMask)
+                for equip in equipChanged]
+
+    def decodeBatch(self, statusList, lastStatus=0):
+        # decode a sequence of status values, given as integers or message arguments
+        # return a list of (index, equipment, old state, new state) for every change
+        result = []
+        for (i, status) in enumerate(statusList):
+            if not isinstance(status, (int, long)):
+                status = self.unpack(status)
+            for (equip, oldState, newState) in self.changes(status, lastStatus):
+                result.append((i, equip, oldState, newState))
+            lastStatus = status
+        return result
 
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import struct
+import time
+
+# capture file format
+#   header: captureMagic
+#   records: recordHeader followed by the bytes that were read
+captureMagic = "AQCAP\x01"
+recordHeader = struct.Struct("!QH")     # microseconds since the start of the capture, length
+
+# clock_gettime clock ids
+clockMonotonic = 1
+clockThreadCpu = 3
+
+try:
+    clockGettime = time.clock_gettime
+except AttributeError:
+    # Python 2 has no clock_gettime, so call it directly
+    import ctypes
+    import ctypes.util
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    _clockGettime = ctypes.CDLL(ctypes.util.find_library("rt"), use_errno=True).clock_gettime
+    _clockGettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def clockGettime(clockId):
+        """ Return the value of a clock in seconds."""
+        t = _timespec()
+        _clockGettime(clockId, ctypes.byref(t))
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+def monotonic():
+    """ Return the value of the monotonic clock in seconds."""
+    return clockGettime(clockMonotonic)
+
+class CaptureFile(object):
+    """ Raw RS485 capture file writer.
+
+    Every chunk of bytes read from the port is written as a record with the time it
+    was read relative to the start of the capture.
+    """
+    def __init__(self, theName, theContext, fileName):
+        self.name = theName
+        self.context = theContext
+        self.fileName = fileName
+        self.captureFile = open(self.fileName, "wb")
+        self.captureFile.write(captureMagic)
+        self.startTime = monotonic()
+        self.context.log(self.name, "capturing to", self.fileName)
+
+    def write(self, data):
+        """ Write a chunk of bytes with the current time."""
+        while data:
+            # a record holds at most 64K bytes
+            chunk = data[:0xffff]
+            data = data[0xffff:]
+            self.captureFile.write(recordHeader.pack(int((monotonic() - self.startTime) * 1000000), len(chunk))+chunk)
+
+    def close(self):
+        self.captureFile.close()
+
+class ReplayPort(object):
+    """ Serial port that plays back a capture file.
+
+    The bytes are returned with the timing they were captured with, divided by the
+    replay speed.  A speed of 0 returns the bytes as fast as they can be read.
+    Anything written to the port is discarded.  The program stops running at the
+    end of the file.
+    """
+    def __init__(self, theName, theContext, fileName, speed=1.0):
+        self.name = theName
+        self.context = theContext
+        self.fileName = fileName
+        self.speed = speed
+        self.replayFile = open(self.fileName, "rb")
+        if self.replayFile.read(len(captureMagic)) != captureMagic:
+            raise IOError("%s is not a capture file" % self.fileName)
+        self.data = ""
+        self.nBytes = 0
+        self.startTime = None
+        self.context.log(self.name, "replaying", self.fileName, "speed", self.speed)
+
+    def nextRecord(self):
+        """ Read the next record and wait until it is due."""
+        header = self.replayFile.read(recordHeader.size)
+        if len(header) < recordHeader.size:
+            return False
+        (offset, length) = recordHeader.unpack(header)
+        self.data = self.replayFile.read(length)
+        if self.startTime is None:
+            self.startTime = monotonic()
+        if self.speed > 0:
+            delay = self.startTime + offset / 1000000.0 / self.speed - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        self.nBytes += len(self.data)
+        return True
+
+    def inWaiting(self):
+        return len(self.data)
+
+    def read(self, size=1):
+        if not self.data:
+            if not self.nextRecord():
+                self.endOfFile()
+                return ""
+        data = self.data[:size]
+        self.data = self.data[size:]
+        return data
+
+    def write(self, data):
+        return len(data)
+
+    def endOfFile(self):
+        if self.context.running:
+            elapsed = monotonic() - self.startTime if self.startTime is not None else 0.0
+            self.context.log(self.name, "end of replay", self.nBytes, "bytes in", "%.3f"%elapsed, "seconds",
+                             "(%d bytes/s)"%(self.nBytes / elapsed) if elapsed > 0 else "")
+            self.context.running = False
+
+    def close(self):
+        self.replayFile.close()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+import time
+import errno
+import fcntl
+import heapq
+import select
+import threading
+import itertools
+import traceback
+import collections
+
+maxSelectTime = 0.5         # longest time the loop waits before checking if the program is running
+maxReaderErrors = 10        # exceptions in a row from a reader before the program stops running
+
+########################################################################################################
+# tasks
+########################################################################################################
+
+class Wait(object):
+    """ Yielded by a task to wait for a threading.Event to be set.
+    The task is sent True if the event was set, or False if the timeout expired."""
+    __slots__ = ["event", "timeout"]
+
+    def __init__(self, theEvent, theTimeout):
+        self.event = theEvent
+        self.timeout = theTimeout
+
+class Task(object):
+    """ A task is a generator that yields Wait objects, or other task generators to
+    run them and receive their results.  The last thing a task yields that is not a
+    Wait or a generator is its result.
+    """
+    def __init__(self, theTask):
+        self.stack = [theTask]
+        self.done = False
+        self.result = None
+
+    def step(self, value):
+        """ Resume the task with a value and return the Wait it yields next, or None
+        when it is done."""
+        while self.stack:
+            try:
+                request = self.stack[-1].send(value)
+            except StopIteration:
+                request = None
+            if isinstance(request, Wait):
+                return request
+            if isinstance(request, collections.Iterator):
+                # run a task within this one
+                self.stack.append(request)
+                value = None
+                continue
+            # the task at the top of the stack has its result
+            self.stack.pop().close()
+            value = request
+        self.done = True
+        self.result = value
+        return None
+
+    def cancel(self):
+        while self.stack:
+            self.stack.pop().close()
+        self.done = True
+        self.result = False
+
+def runTask(theTask):
+    """ Run a task in the calling thread, blocking while it waits, and return its result."""
+    task = Task(theTask)
+    wait = task.step(None)
+    while wait is not None:
+        wait = task.step(wait.event.wait(wait.timeout))
+    return task.result
+
+########################################################################################################
+# event loop
+########################################################################################################
+
+class EventLoop(object):
+    """ Single threaded event loop.
+
+    Calls functions when file descriptors are readable or writable, at given times, or as soon
+    as possible, and runs tasks.  A task waiting for an event is resumed after the
+    callbacks of the iteration in which the event was set, or when its timeout
+    expires.  callSoonThreadsafe wakes the loop from other threads through a pipe.
+    The loop runs until stop is called or the program stops running, and then
+    cancels the tasks that have not completed.
+
+    An exception in a callback is logged and the loop goes on.  A task that raises
+    one is cancelled, and a reader that raises maxReaderErrors in a row stops the
+    program, since nothing else would read its file descriptor.
+    """
+    def __init__(self, theName, theContext):
+        self.name = theName
+        self.context = theContext
+        self.readers = {}               # callbacks indexed by file descriptor
+        self.writers = {}
+        self.readerErrors = {}          # exceptions in a row indexed by file descriptor
+        self.timers = []                # heap of (time, count, Timer)
+        self.ready = collections.deque()
+        self.waiting = []               # (task, wait, deadline, callback)
+        self.counter = itertools.count()
+        self.stopping = False
+        self.running = False            # True while the loop is running
+        self.thread = None
+        (self.wakeRead, self.wakeWrite) = os.pipe()
+        for fd in (self.wakeRead, self.wakeWrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.readers[self.wakeRead] = self.wakeup
+
+    def callSoon(self, callback, *args):
+        """ Call a function on the next iteration.  Only called from the loop."""
+        self.ready.append((callback, args))
+
+    def callSoonThreadsafe(self, callback, *args):
+        """ Call a function on the next iteration from any thread."""
+        self.ready.append((callback, args))
+        if threading.currentThread() is not self.thread:
+            self.wake()
+
+    def callLater(self, delay, callback, *args):
+        """ Call a function after a delay and return a Timer that can cancel it.  Only called from the loop."""
+        timer = Timer(callback, args)
+        heapq.heappush(self.timers, (time.time() + delay, next(self.counter), timer))
+        return timer
+
+    def addReader(self, fd, callback):
+        """ Call a function whenever a file descriptor is readable."""
+        self.callSoonThreadsafe(self.readers.__setitem__, fd, callback)
+
+    def removeReader(self, fd):
+        self.callSoonThreadsafe(self.readers.pop, fd, None)
+
+    def addWriter(self, fd, callback):
+        """ Call a function whenever a file descriptor is writable."""
+        self.callSoonThreadsafe(self.writers.__setitem__, fd, callback)
+
+    def removeWriter(self, fd):
+        self.callSoonThreadsafe(self.writers.pop, fd, None)
+
+    def startTask(self, theTask, callback):
+        """ Start a task and call a function with its result when it completes.  Only called from the loop."""
+        task = Task(theTask)
+        self.resume(task, None, callback)
+        return task
+
+    def resume(self, task, value, callback):
+        try:
+            wait = task.step(value)
+        except Exception:
+            self.logException(task.stack[-1] if task.stack else task)
+            task.cancel()
+            wait = None
+        if wait is None:
+            self.call(callback, task.result)
+        else:
+            self.waiting.append((task, wait, time.time() + wait.timeout, callback))
+
+    def wake(self):
+        # a full pipe will wake the loop anyway
+        try:
+            os.write(self.wakeWrite, "x")
+        except OSError as ex:
+            if ex.errno != errno.EAGAIN:
+                raise
+
+    def wakeup(self):
+        try:
+            os.read(self.wakeRead, 4096)
+        except OSError as ex:
+            if ex.errno != errno.EAGAIN:
+                raise
+
+    def stop(self):
+        """ Stop the loop from any thread."""
+        self.stopping = True
+        self.wake()
+
+    def run(self):
+        """ Run the loop in the calling thread."""
+        self.thread = threading.currentThread()
+        self.running = True
+        if self.context.debug: self.context.logDebug(self.name, "starting event loop")
+        while self.context.running and not self.stopping:
+            # wait for the next reader, timer or task timeout
+            timeout = 0 if self.ready else maxSelectTime
+            if self.timers:
+                timeout = min(timeout, self.timers[0][0] - time.time())
+            for (task, wait, deadline, callback) in self.waiting:
+                timeout = min(timeout, deadline - time.time())
+            (readable, writable, errors) = select.select(self.readers.keys(), self.writers.keys(), [], max(timeout, 0))
+            for fd in readable:
+                if fd in self.readers:
+                    if not self.call(self.readers[fd]):
+                        self.readerFailed(fd)
+                    elif self.readerErrors:
+                        self.readerErrors.pop(fd, None)
+            for fd in writable:
+                if fd in self.writers:
+                    self.call(self.writers[fd])
+            # timers that are due
+            now = time.time()
+            while self.timers and (self.timers[0][0] <= now):
+                timer = heapq.heappop(self.timers)[2]
+                if not timer.cancelled:
+                    self.ready.append((timer.callback, timer.args))
+            # callbacks queued before this point
+            for i in range(len(self.ready)):
+                (callback, args) = self.ready.popleft()
+                self.call(callback, *args)
+            self.resumeTasks()
+        self.running = False
+        self.cancelTasks()
+        if self.context.debug: self.context.logDebug(self.name, "terminating event loop")
+
+    def resumeTasks(self):
+        # resume the tasks whose events have been set or whose timeouts have expired
+        # resuming a task may set an event another task is waiting for
+        while self.waiting:
+            now = time.time()
+            resumed = []
+            waiting = []
+            for entry in self.waiting:
+                (task, wait, deadline, callback) = entry
+                isSet = wait.event.isSet()
+                if isSet or (deadline <= now):
+                    resumed.append((task, isSet, callback))
+                else:
+                    waiting.append(entry)
+            if not resumed:
+                return
+            self.waiting = waiting
+            for (task, isSet, callback) in resumed:
+                self.resume(task, isSet, callback)
+
+    def cancelTasks(self):
+        waiting = self.waiting
+        self.waiting = []
+        for (task, wait, deadline, callback) in waiting:
+            task.cancel()
+            self.call(callback, task.result)
+
+    def call(self, callback, *args):
+        # call a function and return True, or log its exception and return False
+        try:
+            callback(*args)
+            return True
+        except Exception:
+            self.logException(callback)
+            return False
+
+    def logException(self, source):
+        self.context.logError(self.name, "exception in", getattr(source, "__name__", source), "\n"+traceback.format_exc())
+
+    def readerFailed(self, fd):
+        self.readerErrors[fd] = self.readerErrors.get(fd, 0) + 1
+        if self.readerErrors[fd] >= maxReaderErrors:
+            self.context.logError(self.name, "reader of", fd, "keeps failing, stopping")
+            self.context.running = False
+
+    def close(self):
+        os.close(self.wakeRead)
+        os.close(self.wakeWrite)
+
+class Timer(object):
+    """ A function to be called by the loop at a given time."""
+    __slots__ = ["callback", "args", "cancelled"]
+
+    def __init__(self, theCallback, theArgs):
+        self.callback = theCallback
+        self.args = theArgs
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
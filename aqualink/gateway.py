@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+import errno
+import socket
+import collections
+
+from interface import *
+from eventloop import *
+
+maxQueuedAcks = 16          # acks with a button waiting to be sent for an address
+
+class Gateway(object):
+    """ RS485 bus gateway.
+
+    The gateway owns the RS485 port and shares it with any number of clients that
+    connect to context.gatewayListen, tcp://host:port or unix:path.  A client is a
+    program whose RS485Device is the same name, which reads the bus through a
+    GatewayPort.  Every message read from the bus is sent to all the clients, without
+    the noise between messages.  Each client has a buffer of gatewayBufferSize bytes,
+    and a client that can't keep up is disconnected so the bus is never held up.
+
+    A client claims the addresses of its panels when it connects.  The gateway acks
+    the polls of a claimed address right away, so the controller isn't kept waiting
+    for the network.  The acks that the client writes are matched to the polls it
+    was sent in order, and an ack with a button is sent on the bus the next time its
+    address is polled.  Otherwise the last ack the client wrote for the address is
+    sent.  Everything runs in one event loop thread.
+    """
+    def __init__(self, theName, theContext):
+        self.name = theName
+        self.context = theContext
+        self.loop = EventLoop(self.name, self.context)
+        self.port = openSerial(self.context)
+        self.framer = Framer()
+        self.encoder = FrameEncoder()
+        self.defaultAck = self.encoder.ackFrame(0x01, 0x00, 0x00)
+        self.clients = []
+        self.claims = {}            # clients indexed by claimed address
+        self.nFrames = 0
+        self.nDropped = 0           # clients disconnected because they fell behind
+        (family, address) = socketAddress(self.context.gatewayListen)
+        if (family == socket.AF_UNIX) and os.path.exists(address):
+            os.remove(address)
+        self.listener = socket.socket(family, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen(5)
+        self.listener.setblocking(False)
+
+    def run(self):
+        """ Run the gateway in the calling thread until the program stops running."""
+        self.loop.addReader(self.port.fileno(), self.readPort)
+        self.loop.addReader(self.listener.fileno(), self.accept)
+        self.context.log(self.name, "gateway for", self.context.RS485Device, "on", self.context.gatewayListen)
+        self.loop.run()
+        for client in list(self.clients):
+            self.drop(client, "gateway stopped")
+        self.listener.close()
+        self.port.close()
+        self.context.log(self.name, "terminating gateway", "messages", self.nFrames, "dropped clients", self.nDropped)
+
+    def readPort(self):
+        # ack the polls of claimed addresses and send the messages to the clients
+        data = self.port.read(min(max(1, self.port.inWaiting()), readSize))
+        for frame in self.framer.feed(data):
+            self.nFrames += 1
+            msg = self.encoder.wire(frame)
+            client = None
+            if self.encoder.checksum(DLE+STX+frame[:-1]) == frame[-1:]:
+                client = self.claims.get(frame[0])
+            if client:
+                ack = client.nextAck(frame[0])
+                self.port.write(ack)
+                msg += ack
+            for other in list(self.clients):
+                other.send(msg)
+            if client:
+                client.polls.append(frame[0])
+
+    def accept(self):
+        try:
+            (sock, address) = self.listener.accept()
+        except socket.error as ex:
+            if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        clientName = "Client %s:%d" % address if isinstance(address, tuple) else "Client"
+        client = GatewayClient(clientName, self.context, self, sock)
+        self.clients.append(client)
+        self.loop.addReader(sock.fileno(), client.readReady)
+        self.context.log(self.name, client.name, "connected")
+
+    def claim(self, client, addrs):
+        for addr in addrs:
+            if self.claims.get(addr, client) is not client:
+                self.context.logWarning(self.name, client.name, "address", "%02x"%ord(addr), "already claimed by",
+                                        self.claims[addr].name)
+                continue
+            self.claims[addr] = client
+        self.context.log(self.name, client.name, "claimed", self.context.hex(addrs))
+
+    def drop(self, client, reason):
+        # the client may already have been dropped in this iteration of the loop
+        if client.closed:
+            return
+        client.closed = True
+        self.context.log(self.name, client.name, reason)
+        self.clients.remove(client)
+        for (addr, owner) in self.claims.items():
+            if owner is client:
+                del self.claims[addr]
+        self.loop.removeReader(client.sock.fileno())
+        self.loop.removeWriter(client.sock.fileno())
+        client.sock.close()
+
+class GatewayClient(object):
+    """ A program connected to the gateway."""
+    def __init__(self, theName, theContext, theGateway, theSocket):
+        self.name = theName
+        self.context = theContext
+        self.gateway = theGateway
+        self.sock = theSocket
+        self.sock.setblocking(False)
+        self.closed = False
+        self.framer = Framer()
+        self.output = bytearray()       # messages waiting to be sent to the client
+        self.writing = False            # waiting for the socket to be writable
+        self.polls = collections.deque()    # claimed addresses of the messages sent that haven't been acked
+        self.acks = {}                  # acks with a button waiting to be sent, indexed by address
+        self.lastAcks = {}              # last ack for each address
+
+    def nextAck(self, addr):
+        # return the ack to send for a poll of a claimed address
+        acks = self.acks.get(addr)
+        if acks:
+            return acks.popleft()
+        return self.lastAcks.get(addr, self.gateway.defaultAck)
+
+    def send(self, msg):
+        if len(self.output) + len(msg) > self.context.gatewayBufferSize:
+            self.gateway.nDropped += 1
+            self.gateway.drop(self, "dropped, too slow")
+            return
+        self.output += msg
+        if not self.writing:
+            self.writeReady()
+
+    def writeReady(self):
+        if self.closed:
+            return
+        try:
+            n = self.sock.send(self.output)
+        except socket.error as ex:
+            if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                n = 0
+            else:
+                self.gateway.drop(self, "disconnected")
+                return
+        del self.output[:n]
+        if self.output and not self.writing:
+            self.writing = True
+            self.gateway.loop.addWriter(self.sock.fileno(), self.writeReady)
+        elif not self.output and self.writing:
+            self.writing = False
+            self.gateway.loop.removeWriter(self.sock.fileno())
+
+    def readReady(self):
+        if self.closed:
+            return
+        try:
+            data = self.sock.recv(readSize)
+        except socket.error as ex:
+            if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ""
+        if not data:
+            self.gateway.drop(self, "disconnected")
+            return
+        for frame in self.framer.feed(data):
+            if self.gateway.encoder.checksum(DLE+STX+frame[:-1]) != frame[-1:]:
+                continue
+            if frame[0] == claimAddr:
+                self.gateway.claim(self, frame[2:-1])
+            elif (frame[0] == masterAddr) and self.polls:
+                # the ack of the oldest message sent to one of the claimed addresses
+                addr = self.polls.popleft()
+                ack = self.gateway.encoder.wire(frame)
+                if frame[3:4] not in ("", NUL):
+                    acks = self.acks.setdefault(addr, collections.deque(maxlen=maxQueuedAcks))
+                    acks.append(ack)
+                else:
+                    self.lastAcks[addr] = ack
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import fcntl
+import socket
+import struct
+import termios
+
+claimAddr = '\xff'          # a message to this address from a client claims the addresses in its arguments
+
+def isSocketName(name):
+    """ Return True if a device name is a socket, tcp://host:port or unix:path."""
+    return name.startswith("tcp://") or name.startswith("unix:")
+
+def socketAddress(name):
+    """ Return the address family and address of a socket name."""
+    if name.startswith("tcp://"):
+        (host, port) = name[len("tcp://"):].rsplit(":", 1)
+        return (socket.AF_INET, (host, int(port)))
+    return (socket.AF_UNIX, name[len("unix:"):])
+
+class GatewayPort(object):
+    """ Serial port that is a connection to a bus gateway.
+
+    The gateway sends the messages it reads from the bus, and the messages written
+    to the port are sent to it.  The acks written are sent on the bus by the gateway
+    the next time the controller polls the address they are for, which is claimed
+    with claim when the port is opened.  The program stops running if the gateway
+    closes the connection.
+    """
+    def __init__(self, theName, theContext, deviceName, timeout):
+        self.name = theName
+        self.context = theContext
+        self.deviceName = deviceName
+        (family, address) = socketAddress(self.deviceName)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        self.sock.settimeout(timeout)
+        self.context.log(self.name, "connected to", self.deviceName)
+
+    def claim(self, claimMsg):
+        """ Send the message that claims the addresses of the panels."""
+        self.sock.sendall(claimMsg)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def inWaiting(self):
+        return struct.unpack("I", fcntl.ioctl(self.sock.fileno(), termios.FIONREAD, "\0\0\0\0"))[0]
+
+    def read(self, size=1):
+        try:
+            data = self.sock.recv(size)
+        except socket.timeout:
+            return ""
+        except socket.error as ex:
+            self.closed(ex)
+            return ""
+        if not data:
+            self.closed("connection closed")
+        return data
+
+    def write(self, data):
+        try:
+            self.sock.sendall(data)
+        except socket.error as ex:
+            self.closed(ex)
+            return 0
+        return len(data)
+
+    def closed(self, reason):
+        # the program can't run without the gateway
+        if self.context.running:
+            self.context.logWarning(self.name, "lost", self.deviceName, reason)
+            self.context.running = False
+
+    def close(self):
+        self.sock.close()
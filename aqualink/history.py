@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+import threading
+
+# numpy is only needed for the history
+try:
+    import numpy
+    historyAvailable = True
+except ImportError:
+    historyAvailable = False
+
+# history file format
+#   records: time, metric number, value
+if historyAvailable:
+    recordType = numpy.dtype([("time", "<f8"), ("metric", "<u2"), ("value", "<f4")])
+
+class History(object):
+    """ Time series of state values.
+
+    Each metric has a ring buffer of the last size samples in memory.  Samples are
+    added when a value changes, and are appended to the history file when flush is
+    called.  When the program starts, the ring buffers are loaded from the end of
+    the file, a partial record at its end is truncated, and the file is rewritten if
+    it holds more than twice what the ring buffers can.
+
+    Queries return the samples in a time range, or the minimum, maximum and mean of
+    the samples in a number of equal time intervals.
+    """
+    def __init__(self, theName, theContext, theNames, fileName, size):
+        self.name = theName
+        self.context = theContext
+        self.names = theNames
+        self.metrics = dict((name, metric) for (metric, name) in enumerate(self.names))
+        self.fileName = fileName
+        self.size = size
+        self.lock = threading.Lock()
+        self.times = numpy.zeros((len(self.names), self.size), "<f8")
+        self.values = numpy.zeros((len(self.names), self.size), "<f4")
+        self.counts = [0] * len(self.names)     # samples added to each ring buffer
+        self.pending = []                       # samples not yet written to the file
+        self.load()
+
+    def load(self):
+        """ Fill the ring buffers from the history file."""
+        if not os.path.exists(self.fileName):
+            return
+        size = os.path.getsize(self.fileName)
+        nRecords = size // recordType.itemsize
+        if size != nRecords * recordType.itemsize:
+            # the last record was only partly written, drop it so the samples appended after it are aligned
+            with open(self.fileName, "r+b") as historyFile:
+                historyFile.truncate(nRecords * recordType.itemsize)
+            self.context.logWarning(self.name, "dropped", size - nRecords * recordType.itemsize,
+                                    "bytes of a partial record from", self.fileName)
+        if nRecords == 0:
+            return
+        records = numpy.memmap(self.fileName, recordType, "r", shape=(nRecords,))
+        kept = []
+        for metric in range(len(self.names)):
+            samples = records[records["metric"] == metric][-self.size:]
+            n = len(samples)
+            self.times[metric, :n] = samples["time"]
+            self.values[metric, :n] = samples["value"]
+            self.counts[metric] = n
+            kept.append(samples)
+        nRecords = len(records)
+        del records
+        self.context.log(self.name, "loaded", sum(self.counts), "samples from", self.fileName)
+        if nRecords > 2 * len(self.names) * self.size:
+            # drop the records that are no longer in memory
+            records = numpy.concatenate(kept)
+            records = records[numpy.argsort(records["time"], kind="mergesort")]
+            tmpFileName = self.fileName+".tmp"
+            records.tofile(tmpFileName)
+            os.rename(tmpFileName, self.fileName)
+            if self.context.debug: self.context.logDebug(self.name, "compacted", nRecords, "records to", len(records))
+
+    def add(self, theTime, values):
+        """ Add samples for a dictionary of metric values."""
+        with self.lock:
+            for (name, value) in values.items():
+                metric = self.metrics[name]
+                i = self.counts[metric] % self.size
+                self.times[metric, i] = theTime
+                self.values[metric, i] = value
+                self.counts[metric] += 1
+                self.pending.append((theTime, metric, value))
+
+    def flush(self):
+        """ Append the pending samples to the history file."""
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        if pending:
+            with open(self.fileName, "ab") as historyFile:
+                numpy.array(pending, recordType).tofile(historyFile)
+
+    def samples(self, name):
+        # return copies of the times and values of a metric in time order
+        metric = self.metrics[name]
+        with self.lock:
+            count = self.counts[metric]
+            if count <= self.size:
+                return (self.times[metric, :count].copy(), self.values[metric, :count].copy())
+            i = count % self.size
+            return (numpy.concatenate((self.times[metric, i:], self.times[metric, :i])),
+                    numpy.concatenate((self.values[metric, i:], self.values[metric, :i])))
+
+    def query(self, name, start=None, end=None):
+        """ Return the times and values of the samples of a metric from start to end."""
+        (times, values) = self.samples(name)
+        first = 0 if start is None else numpy.searchsorted(times, start, "left")
+        last = len(times) if end is None else numpy.searchsorted(times, end, "right")
+        return (times[first:last], values[first:last])
+
+    def downsample(self, name, start, end, points):
+        """ Return the start times of the intervals that have samples, and the minimum,
+        maximum and mean of the samples in each of them."""
+        (times, values) = self.query(name, start, end)
+        if len(times) == 0:
+            return (times, values, values, values)
+        # index of the first sample in each interval that has samples
+        edges = numpy.linspace(start, end, points+1)[:-1]
+        firsts = numpy.unique(numpy.searchsorted(times, edges, "left"))
+        firsts = firsts[firsts < len(times)]
+        counts = numpy.diff(numpy.append(firsts, len(times)))
+        intervals = numpy.searchsorted(edges, times[firsts], "right") - 1
+        return (edges[intervals],
+                numpy.minimum.reduceat(values, firsts),
+                numpy.maximum.reduceat(values, firsts),
+                numpy.add.reduceat(values.astype("<f8"), firsts) / counts)
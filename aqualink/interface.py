@@ -2,8 +2,14 @@
 # coding=utf-8
 
 import serial
-import struct
+import time
+import Queue
 import threading
+import collections
+
+from capture import *
+from gatewayport import *
+from sniffer import *
 
 # ASCII constants
 NUL = '\x00'
@@ -13,112 +19,365 @@ ETX = '\x03'
 
 masterAddr = '\x00'          # address of Aqualink controller
 
+readSize = 4096              # maximum number of bytes read from the port at once
+readTimeout = 0.5            # time a read waits for data before checking if the program is running
+maxFrameLen = 64             # longest message body accepted before resynchronizing
+
+# ack turnaround histogram buckets in seconds
+ackBuckets = [0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1]
+
+byteChr = [chr(i) for i in range(256)]     # single byte strings indexed by value
+
 class Interface(object):
     """ Aqualink serial interface
 
     """
     def __init__(self, theName, theContext, thePool):
         """Initialization.
-        Open the serial port and find the start of a message."""
+        Open the serial port and set up the message framer.
+        Messages are not read until start() is called."""
         self.name = theName
         self.context = theContext
         self.pool = thePool
-        if self.context.debugData: self.context.log(self.name, "opening RS485 port", self.context.RS485Device)
-        self.port = serial.Serial(self.context.RS485Device, baudrate=9600, 
-                                  bytesize=serial.EIGHTBITS, 
-                                  parity=serial.PARITY_NONE, 
-                                  stopbits=serial.STOPBITS_ONE)
-        self.msg = "\x00\x00"
+        self.port = self.openPort()
+        self.capture = None
+        if self.context.captureFile != "":
+            self.capture = CaptureFile("Capture", self.context, self.context.captureFile)
+        self.sniffer = None
+        if self.context.sniffOutput != "":
+            self.sniffer = Sniffer("Sniffer", self.context, self.context.sniffOutput,
+                                   self.context.sniffAddrs, self.context.sniffCmds)
+            self.pool.metrics.gauge("aqualink_sniffer_drops_total", "Bus events dropped because the sniffer queue was full",
+                                    lambda: self.sniffer.drops, "counter")
+        self.framer = Framer()
+        self.frames = collections.deque()
+        self.readTime = 0.0     # time the last chunk was read
+        self.lastPanel = None   # panel the last message that wasn't to the master was addressed to
         self.debugRawMsg = ""
-        # skip bytes until synchronized with the start of a message
-        while (self.msg[-1] != STX) or (self.msg[-2] != DLE):
-            self.msg += self.port.read(1)
-            if self.context.debugRaw: self.debugRaw(self.msg[-1])
-        self.msg = self.msg[-2:]
-        if self.context.debugData: self.context.log(self.name, "synchronized")
-        # start up the read thread
-        readThread = ReadThread("Read", self.context, self.pool)
-        readThread.start()
+        self.frameCounter = self.pool.metrics.counter("aqualink_frames_total",
+                                "Messages with a valid checksum by destination address", ("addr",), addrLabel)
+        self.badChecksumCounter = self.pool.metrics.counter("aqualink_bad_checksums_total",
+                                "Messages with a bad checksum by destination address", ("addr",), addrLabel)
+        self.ackTurnaround = self.pool.metrics.histogram("aqualink_ack_turnaround_seconds",
+                                "Time from reading a message to sending its ack", ackBuckets)
+        self.ackMissCounter = self.pool.metrics.counter("aqualink_ack_deadline_misses_total",
+                                "Acks sent more than ackDeadline after reading the message")
+        # the framer skips bytes until it is synchronized with the start of a message
+        if self.context.debugData: self.context.logDebug(self.name, "synchronizing")
+
+    def openPort(self):
+        """ Open the RS485 port, the capture file being replayed, or the connection to a
+        gateway that owns the port."""
+        if self.context.replayFile != "":
+            return ReplayPort("Replay", self.context, self.context.replayFile, self.context.replaySpeed)
+        if isSocketName(self.context.RS485Device):
+            port = GatewayPort("Gateway", self.context, self.context.RS485Device, readTimeout)
+            # claim the panel addresses unless passively monitoring
+            addrs = "" if self.context.monitorMode else \
+                    "".join(byteChr[addr] for addr in range(256) if self.pool.panelTable[addr] is not None)
+            port.claim(self.pool.encoder.encode((claimAddr, '\x00', addrs)))
+            return port
+        return openSerial(self.context)
+
+    def start(self):
+        """ Start reading messages in the read thread, or in the event loop if there is one."""
+        if self.pool.loop:
+            if hasattr(self.port, "fileno"):
+                self.pool.loop.addReader(self.port.fileno(), self.readReady)
+            else:
+                # a replay port can't be selected, so read it whenever the loop is idle
+                self.pool.loop.callSoonThreadsafe(self.replayReady)
+        else:
+            readThread = ReadThread("Read", self.context, self.pool)
+            readThread.start()
+        if self.sniffer: self.sniffer.start()
         self.context.log(self.name, "ready")
           
+    def readFrame(self):
+        """ Read the next message body from the serial port, or None if the program
+        stopped running."""
+        while not self.frames:
+            # read everything that is waiting in one chunk
+            data = self.port.read(min(max(1, self.port.inWaiting()), readSize))
+            if not self.context.running: return None
+            self.addData(data)
+        return self.frames.popleft()
+
     def readMsg(self):
         """ Read the next valid message from the serial port.
         Parses and returns the destination address, command, and arguments as a 
         tuple."""
         while self.context.running:                                         
-            if not self.context.running: break
-            dleFound = False
-            # read what is probably the DLE STX
-            self.msg += self.port.read(2)                   
-            if self.context.debugRaw: 
-                self.debugRaw(self.msg[-2])
-                self.debugRaw(self.msg[-1])
-            while (self.msg[-1] != ETX) or (not dleFound):  
-                # read until DLE ETX
-                self.msg += self.port.read(1)
-                if self.context.debugRaw: self.debugRaw(self.msg[-1])
-                if self.msg[-1] == DLE:                     
-                    # \x10 read, tentatively is a DLE
-                    dleFound = True
-                if (self.msg[-2] == DLE) and (self.msg[-1] == NUL) and dleFound: 
-                    # skip a NUL following a DLE
-                    self.msg = self.msg[:-1]
-                    # it wasn't a DLE after all
-                    dleFound = False                        
-            # skip any NULs between messages
-            self.msg = self.msg.lstrip('\x00')
-            # parse the elements of the message              
-            dlestx = self.msg[0:2]
-            dest = self.msg[2:3]
-            cmd = self.msg[3:4]
-            args = self.msg[4:-3]
-            checksum = self.msg[-3:-2]
-            dleetx = self.msg[-2:]
-            if self.context.debugData: debugMsg = dlestx.encode("hex")+" "+dest.encode("hex")+" "+\
-                                     cmd.encode("hex")+" "+args.encode("hex")+" "+\
-                                     checksum.encode("hex")+" "+dleetx.encode("hex")
-            self.msg = ""
+            frame = self.readFrame()
+            if frame is None: return None
+            msg = self.checkFrame(frame)
             # stop reading if a message with a valid checksum is read
-            if self.checksum(dlestx+dest+cmd+args) == checksum:
-                if self.context.debugData: self.context.log(self.name, "-->", debugMsg)
-                return (dest, cmd, args)
-            else:
-                if self.context.debugData: self.context.log(self.name, "-->", debugMsg, 
-                                  "*** bad checksum ***")
+            if msg is not None:
+                return msg
+
+    def readReady(self):
+        """ Read the data waiting on the port and handle the messages in it.
+        Called by the event loop when the port is readable.  The messages in the chunk
+        are all acked before any of them is parsed."""
+        if self.pool.profiler.pending: self.pool.profiler.update()
+        self.addData(self.port.read(min(max(1, self.port.inWaiting()), readSize)))
+        acks = [(frame,)+self.ackFrame(frame) for frame in self.frames]
+        self.frames.clear()
+        for (frame, valid, button) in acks:
+            self.parseFrame(frame, valid, button)
+
+    def replayReady(self):
+        self.readReady()
+        if self.context.running:
+            self.pool.loop.callSoon(self.replayReady)
+
+    def addData(self, data):
+        """ Add a chunk of data read from the port to the messages waiting to be handled."""
+        if self.context.metricsEnabled or self.sniffer: self.readTime = time.time()
+        if self.capture: self.capture.write(data)
+        if self.context.debugRaw: self.debugRaw(data)
+        self.frames.extend(self.framer.feed(data))
+
+    def checkFrame(self, frame):
+        """ Parse a message body and return the destination address, command, and
+        arguments as a tuple, or None if the checksum is bad."""
+        return self.splitFrame(frame, self.validFrame(frame))
+
+    def validFrame(self, frame):
+        """ Return True if the checksum of a message body is good."""
+        return self.checksum(DLE+STX+frame[:-1]) == frame[-1:]
+
+    def splitFrame(self, frame, valid):
+        """ Count and log a message body that has been checked and return the destination
+        address, command, and arguments as a tuple, or None if the checksum is bad."""
+        dest = frame[0:1]
+        cmd = frame[1:2]
+        args = frame[2:-1]
+        if valid:
+            if self.context.metricsEnabled: self.frameCounter.inc(dest)
+            if self.context.debugData: self.context.logDebug(self.name, "-->", *self.debugFrame(frame))
+            return (dest, cmd, args)
+        else:
+            if self.context.metricsEnabled: self.badChecksumCounter.inc(dest)
+            if self.context.debugData: self.context.logDebug(self.name, "-->", 
+                              *(self.debugFrame(frame)+("*** bad checksum ***",)))
+            return None
+
+    def ackFrame(self, frame):
+        """ Check a message body and, if it is addressed to one of the panels, send an
+        Ack to the controller right away.  Nothing is logged or parsed until the ack has
+        been sent.  Returns whether the checksum is good and the button that was sent,
+        or None if no ack was sent."""
+        valid = self.validFrame(frame)
+        button = None
+        # no ack if passively monitoring
+        if valid and not self.context.monitorMode:
+            slot = self.pool.panelTable[ord(frame[0])]
+            if slot is not None:
+                (button, ack) = slot.getAck()
+                self.port.write(ack)
+                if self.context.metricsEnabled:
+                    turnaround = time.time() - self.readTime
+                    self.ackTurnaround.observe(turnaround)
+                    if turnaround > self.context.ackDeadline: self.ackMissCounter.inc()
+        # record every message on the bus if requested
+        if self.sniffer: self.sniffer.add(self.readTime, frame, valid)
+        return (valid, button)
+
+    def parseFrame(self, frame, valid, button):
+        """ Log a message body that has been acked and the ack, and process the command."""
+        msg = self.splitFrame(frame, valid)
+        if msg is None: return
+        if button is not None:
+            slot = self.pool.panelTable[ord(msg[0])]
+            panel = slot.panel
+            if self.context.debugData: self.debugSend(panel.ackFrames[button.code])
+            if self.context.debugAck and (button is not panel.btnNone):
+                self.context.logDebug(panel.name, "ack", "%02x"%ord(slot.addr), "%02x%02x"%(panel.ack, button.code))
+        self.handleMsg(msg)
+
+    def handleMsg(self, (dest, cmd, args)):
+        """ If a message is addressed to one of the panels, process the command."""
+        if dest == masterAddr:
+            # parse ack messages to master that are from these panels and ignore the others
+            if self.lastPanel is not None:
+                self.pool.master.parseMsg(cmd, args)
+            return
+        slot = self.pool.panelTable[ord(dest)]
+        self.lastPanel = slot
+        if slot is not None:
+            # handle messages that are addressed to these panels
+            slot.parseMsg(cmd, args)
+
+    def debugFrame(self, frame):
+        """ Return the elements of a message body to be logged as hex."""
+        return (self.context.hex(DLE+STX), self.context.hex(frame[0:1]), self.context.hex(frame[1:2]),
+                self.context.hex(frame[2:-1]), self.context.hex(frame[-1:]), self.context.hex(DLE+ETX))
 
     def sendMsg(self, (dest, cmd, args)):
         """ Send a message.
         The destination address, command, and arguments are specified as a tuple."""
-        msg = DLE+STX+dest+cmd+args
-        msg = msg+self.checksum(msg)+DLE+ETX
-        for i in range(2,len(msg)-2):                       
-            # if a byte in the message has the value \x10 insert a NUL after it
-            if msg[i] == DLE:
-                msg = msg[0:i+1]+NUL+msg[i+1:]
-        if self.context.debugData: self.context.log(self.name, "<--", msg[0:2].encode("hex"), 
-                          msg[2:3].encode("hex"), msg[3:4].encode("hex"), 
-                          msg[4:-3].encode("hex"), msg[-3:-2].encode("hex"), 
-                          msg[-2:].encode("hex"))
+        self.sendFrame(self.pool.encoder.encode((dest, cmd, args)))
+
+    def sendFrame(self, msg):
+        """ Send a message that has already been encoded for the wire."""
+        if self.context.debugData: self.debugSend(msg)
         n = self.port.write(msg)
 
+    def debugSend(self, msg):
+        """ Log the elements of a message that is sent as hex."""
+        self.context.logDebug(self.name, "<--", self.context.hex(msg[0:2]), 
+                              self.context.hex(msg[2:3]), self.context.hex(msg[3:4]), 
+                              self.context.hex(msg[4:-3]), self.context.hex(msg[-3:-2]), 
+                              self.context.hex(msg[-2:]))
+
     def checksum(self, msg):
         """ Compute the checksum of a string of bytes."""                
-        return struct.pack("!B", reduce(lambda x,y:x+y, map(ord, msg)) % 256)
+        return self.pool.encoder.checksum(msg)
 
-    def debugRaw(self, byte):
+    def debugRaw(self, data):
         """ Debug raw serial data."""
-        self.debugRawMsg += byte
-        if len(self.debugRawMsg) == 16:
-            self.context.log(self.name, self.debugRawMsg).encode("hex")
-            self.debugRawMsg = ""
+        self.debugRawMsg += data
+        while len(self.debugRawMsg) >= 16:
+            self.context.logDebug(self.name, self.context.hex(self.debugRawMsg[:16]))
+            self.debugRawMsg = self.debugRawMsg[16:]
             
     def __del__(self):
         """ Clean up."""
+        if self.capture: self.capture.close()
         self.port.close()
                 
+def openSerial(context):
+    """ Open the RS485 serial port."""
+    if context.debugData: context.logDebug("RS485", "opening RS485 port", context.RS485Device)
+    return serial.Serial(context.RS485Device, baudrate=9600, 
+                         bytesize=serial.EIGHTBITS, 
+                         parity=serial.PARITY_NONE, 
+                         stopbits=serial.STOPBITS_ONE,
+                         timeout=readTimeout)
+
+def addrLabel(addr):
+    """ Return the label of a metric counted by address."""
+    return ("%02x" % ord(addr),)
+
+class Framer(object):
+    """ Incremental RS485 message framer.
+
+    Bytes are fed in chunks of any size.  The framer looks for DLE STX, collects the
+    message body while removing the NUL that follows a DLE in the data, and ends the
+    message at DLE ETX.  Each complete body (destination, command, arguments and
+    checksum) is returned as a string.  State is kept between calls so a message may
+    be split across any number of chunks and a chunk may contain several messages.
+    """
+    # framer states
+    stateHunt = 0           # looking for DLE
+    stateStart = 1          # DLE found, expecting STX
+    stateBody = 2           # reading the message body
+    stateEscape = 3         # DLE found in the body
+
+    def __init__(self):
+        self.state = Framer.stateHunt
+        self.buf = bytearray()          # reused for every message
+
+    def feed(self, data):
+        """ Add a chunk of bytes and return a list of the complete messages found."""
+        frames = []
+        buf = self.buf
+        state = self.state
+        i = 0
+        n = len(data)
+        while i < n:
+            if state == Framer.stateBody:
+                # copy everything up to the next DLE in one step
+                j = data.find(DLE, i)
+                if j < 0:
+                    buf.extend(data[i:])
+                    i = n
+                else:
+                    buf.extend(data[i:j])
+                    i = j+1
+                    state = Framer.stateEscape
+                if len(buf) > maxFrameLen:
+                    state = Framer.stateHunt
+            elif state == Framer.stateHunt:
+                j = data.find(DLE, i)
+                if j < 0:
+                    break
+                i = j+1
+                state = Framer.stateStart
+            elif state == Framer.stateStart:
+                byte = data[i]
+                i += 1
+                if byte == STX:
+                    del buf[:]
+                    state = Framer.stateBody
+                elif byte != DLE:
+                    state = Framer.stateHunt
+            else:   # stateEscape
+                byte = data[i]
+                i += 1
+                if byte == ETX:
+                    # end of the message
+                    if len(buf) >= 3:
+                        frames.append(str(buf))
+                    state = Framer.stateHunt
+                elif byte == NUL:
+                    # a NUL following a DLE means the DLE was data
+                    buf.append(DLE)
+                    state = Framer.stateBody
+                elif byte == STX:
+                    # start of a new message without the end of the last one
+                    del buf[:]
+                    state = Framer.stateBody
+                elif byte == DLE:
+                    buf.append(DLE)
+                else:
+                    buf.append(DLE)
+                    buf.append(byte)
+                    state = Framer.stateBody
+        self.state = state
+        return frames
+
+class FrameEncoder(object):
+    """ Aqualink message encoder.
+
+    Builds complete messages ready to be written to the port.  Ack messages are
+    built once for every button of a panel and looked up when the panel is polled.
+    """
+    def __init__(self):
+        self.ackCache = {}
+
+    def checksum(self, msg):
+        """ Compute the checksum of a string of bytes."""
+        return byteChr[sum(bytearray(msg)) & 0xff]
+
+    def encode(self, (dest, cmd, args)):
+        """ Encode a message.
+        The destination address, command, and arguments are specified as a tuple."""
+        msg = dest+cmd+args
+        return self.wire(msg+self.checksum(DLE+STX+msg))
+
+    def wire(self, body):
+        """ Return the message to be written for a message body that has its checksum."""
+        # insert a NUL after any byte in the message that has the value \x10
+        return DLE+STX+body.replace(DLE, DLE+NUL)+DLE+ETX
+
+    def ackFrame(self, cmdCode, ack, buttonCode):
+        """ Return the encoded ack message to the controller for a button."""
+        key = (cmdCode, ack, buttonCode)
+        try:
+            return self.ackCache[key]
+        except KeyError:
+            frame = self.encode((masterAddr, byteChr[cmdCode], byteChr[ack]+byteChr[buttonCode]))
+            self.ackCache[key] = frame
+            return frame
+
 class ReadThread(threading.Thread):
     """ Message reading thread.
 
+    Reads messages and sends the acks.  If context.fastAck is set, the messages are
+    queued to a ParseThread to be logged and parsed, otherwise they are parsed here
+    after the ack has been sent.
     """
     def __init__(self, theName, theContext, thePool):
         """ Initialize the thread."""        
@@ -126,34 +385,65 @@ class ReadThread(threading.Thread):
         self.name = theName
         self.context = theContext
         self.pool = thePool
-        self.lastDest = 0xff
+        self.parseThread = ParseThread("Parse", self.context, self.pool) if self.context.fastAck else None
         
     def readData(self):
         """ Message handling loop.
         Read messages from the interface and if they are addressed to one of the
         panels, send an Ack to the controller and process the command."""
-        if self.context.debug: self.context.log(self.name, "starting read thread")
+        if self.context.debug: self.context.logDebug(self.name, "starting read thread")
+        interface = self.pool.interface
+        parseThread = self.parseThread
+        if parseThread: parseThread.start()
         while self.context.running:
             # read until the program state changes to not running
-            if not self.context.running: break
-            (dest, cmd, args) = self.pool.interface.readMsg()
-            try:                         
-                # handle messages that are addressed to these panels
-                if not self.context.monitorMode:      
-                    # send Ack if not passively monitoring
-                    self.pool.interface.sendMsg((masterAddr,) + \
-                                                self.pool.panels[dest].getAckMsg())
-                self.pool.panels[dest].parseMsg(cmd, args)
-                self.lastDest = dest
-            except KeyError:                      
-                # ignore other messages except...
-                if (dest == masterAddr) and \
-                        (self.lastDest in self.pool.panels.keys()): 
-                    # parse ack messages to master that are from these panels
-                    self.pool.master.parseMsg(cmd, args)
-        # force all pending panel events to complete
-        for panel in self.pool.panels.values():   
-            for event in panel.events:
-                event.set()
-        if self.context.debug: self.context.log(self.name, "terminating read thread")
+            if self.pool.profiler.pending and not parseThread: self.pool.profiler.update()
+            frame = interface.readFrame()
+            if frame is None: break
+            (valid, button) = interface.ackFrame(frame)
+            if parseThread:
+                parseThread.queue.put((frame, valid, button))
+            else:
+                interface.parseFrame(frame, valid, button)
+        if parseThread:
+            parseThread.queue.put(None)
+        else:
+            finishParsing(self.pool)
+        if self.context.debug: self.context.logDebug(self.name, "terminating read thread")
+
+class ParseThread(threading.Thread):
+    """ Message parsing thread.
+
+    Logs and parses the messages that the read thread has acked, in the order they
+    were read.  The profiler captures this thread instead of the read thread.
+    """
+    def __init__(self, theName, theContext, thePool):
+        """ Initialize the thread."""        
+        threading.Thread.__init__(self, target=self.parseData)
+        self.name = theName
+        self.context = theContext
+        self.pool = thePool
+        self.queue = Queue.Queue()      # (frame, valid, button) and None at the end
+        
+    def parseData(self):
+        if self.context.debug: self.context.logDebug(self.name, "starting parse thread")
+        interface = self.pool.interface
+        while True:
+            if self.pool.profiler.pending: self.pool.profiler.update()
+            try:
+                item = self.queue.get(True, readTimeout)
+            except Queue.Empty:
+                continue
+            if item is None: break
+            interface.parseFrame(*item)
+        finishParsing(self.pool)
+        if self.context.debug: self.context.logDebug(self.name, "terminating parse thread")
 
+def finishParsing(pool):
+    """ Clean up when the messages are no longer parsed."""
+    # finish a profile that is being captured
+    if pool.profiler.captureProfile: pool.profiler.update()
+    # force all pending panel events to complete
+    for panel in pool.panelList:
+        for event in panel.events:
+            event.set()
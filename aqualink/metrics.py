@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import bisect
+import threading
+
+# latency histogram buckets in seconds
+latencyBuckets = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0]
+
+class Metrics(object):
+    """ Registry of counters, histograms and gauges.
+
+    Code that updates a metric checks context.metricsEnabled first, so nothing is
+    counted when metrics are turned off.  The metrics are formatted in the
+    Prometheus text format when they are collected.
+    """
+    def __init__(self, theName, theContext):
+        self.name = theName
+        self.context = theContext
+        self.metrics = []
+        self.metricTable = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, metricClass, *args):
+        # return the metric with a name, creating it the first time
+        # objects of the same class, such as panels, share their metrics
+        with self.lock:
+            try:
+                return self.metricTable[name]
+            except KeyError:
+                metric = metricClass(name, *args)
+                self.metricTable[name] = metric
+                self.metrics.append(metric)
+                return metric
+
+    def counter(self, name, help, labelNames=(), labelFormat=None):
+        return self.register(name, Counter, help, labelNames, labelFormat)
+
+    def histogram(self, name, help, buckets=latencyBuckets):
+        return self.register(name, Histogram, help, buckets)
+
+    def gauge(self, name, help, function, metricType="gauge"):
+        return self.register(name, Gauge, help, function, metricType)
+
+    def format(self):
+        """ Return all the metrics in the Prometheus text format."""
+        return "".join(metric.format() for metric in self.metrics)
+
+def formatHeader(name, help, metricType):
+    return "# HELP %s %s\n# TYPE %s %s\n" % (name, help, name, metricType)
+
+def formatLabels(labelNames, labelValues):
+    if not labelNames:
+        return ""
+    return "{"+",".join('%s="%s"' % label for label in zip(labelNames, labelValues))+"}"
+
+class Counter(object):
+    """ Counts indexed by a label key.
+
+    The key is the raw value the code has at hand, such as an address byte, and
+    labelFormat turns it into the tuple of label values when the metrics are
+    collected.  Each key is only incremented by one thread."""
+    def __init__(self, theName, theHelp, theLabelNames, theLabelFormat):
+        self.name = theName
+        self.help = theHelp
+        self.labelNames = theLabelNames
+        self.labelFormat = theLabelFormat if theLabelFormat else lambda key: (key,)
+        self.counts = {} if self.labelNames else {None: 0}   # a counter without labels starts at 0
+
+    def inc(self, key=None, n=1):
+        self.counts[key] = self.counts.get(key, 0) + n
+
+    def format(self):
+        lines = [formatHeader(self.name, self.help, "counter")]
+        for (key, count) in sorted(self.counts.items()):
+            lines.append("%s%s %d\n" % (self.name, formatLabels(self.labelNames, self.labelFormat(key)), count))
+        return "".join(lines)
+
+class Histogram(object):
+    """ Distribution of observed values in fixed buckets."""
+    def __init__(self, theName, theHelp, theBuckets):
+        self.name = theName
+        self.help = theHelp
+        self.buckets = theBuckets
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def format(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = [formatHeader(self.name, self.help, "histogram")]
+        count = 0
+        for (bucket, n) in zip(self.buckets + ["+Inf"], counts):
+            count += n
+            lines.append('%s_bucket{le="%s"} %d\n' % (self.name, bucket, count))
+        lines.append("%s_sum %f\n%s_count %d\n" % (self.name, total, self.name, count))
+        return "".join(lines)
+
+class Gauge(object):
+    """ A value read from a function when the metrics are collected."""
+    def __init__(self, theName, theHelp, theFunction, theType):
+        self.name = theName
+        self.help = theHelp
+        self.function = theFunction
+        self.type = theType
+
+    def format(self):
+        return formatHeader(self.name, self.help, self.type)+"%s %s\n" % (self.name, self.function())
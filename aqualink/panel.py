@@ -1,11 +1,13 @@
 #!/usr/bin/env python
 # coding=utf-8
 
-import struct
 import time
 import threading
+import itertools
+import Queue
 
 from pool import *
+from eventloop import *
 
 ########################################################################################################
 # Base Aqualink control panel
@@ -33,9 +35,10 @@ class Panel(object):
 
         # state
         self.ack = 0x00             # first byte of ack message
-        self.button = self.btnNone       # current button pressed
+        self.slots = []             # addresses the panel answers polls on, the first is the primary one
         self.lastAck = 0x0000
         self.lastStatus = 0x0000000000
+        self.ackFrames = {}         # encoded ack messages indexed by button code
 
         # command parsing
         self.cmdTable = {self.cmdProbe.code: Panel.handleProbe,
@@ -46,47 +49,69 @@ class Panel(object):
         # action events
         self.statusEvent = threading.Event()   # a status message has been received
         self.events = [self.statusEvent]
+
+        # actions are performed one at a time by the executor
+        self.executor = ActionExecutor(self.name+" Actions", self.context, self)
+
+        self.msgCounter = self.pool.metrics.counter("aqualink_messages_total", "Messages parsed by panel and command",
+                                ("panel", "cmd"), lambda (panel, cmdCode): (panel, "%02x" % cmdCode))
         
-    # return the ack message for this panel        
-    def getAckMsg(self):
-        args = struct.pack("!B", self.ack)+struct.pack("!B", self.button.code)
-        if self.button != self.btnNone:
-            if self.context.debugAck: self.context.log(self.name, "ack", args.encode("hex"))
-        self.button = self.btnNone
-        return (struct.pack("!B", self.cmdAck.code), args)
+    # encode the ack messages for all the buttons of this panel
+    def buildAckFrames(self):
+        for button in vars(self).values():
+            if isinstance(button, Button):
+                self.ackFrames[button.code] = self.pool.encoder.ackFrame(self.cmdAck.code, self.ack, button.code)
+
+    # answer polls on another address
+    def addSlot(self, addr):
+        slot = AckSlot(addr, self, not self.slots)
+        self.slots.append(slot)
+        self.events.append(slot.ackEvent)
+        return slot
+
+    # parse only the status messages sent to a secondary address, the others repeat what the primary one gets
+    def parseStatus(self, cmd, args):
+        if ord(cmd) == self.cmdStatus.code:
+            self.parseMsg(cmd, args)
         
     # parse a message and perform commands    
     def parseMsg(self, cmd, args):
-        cmdCode = int(cmd.encode("hex"), 16)
+        cmdCode = ord(cmd)
+        if self.context.metricsEnabled: self.msgCounter.inc((self.name, cmdCode))
         try:
-            self.cmdTable[cmdCode](self, args)
+            handler = self.cmdTable[cmdCode]
         except KeyError:
-            if self.context.debug: self.context.log(self.name, "unknown", cmd.encode("hex"), args.encode("hex"))
+            if self.context.debug: self.context.logDebug(self.name, "unknown", self.context.hex(cmd), self.context.hex(args))
+            return
+        if self.context.profileInterval:
+            self.pool.profiler.call(handler, self, args)
+        else:
+            handler(self, args)
 
     # probe command           
     def handleProbe(self, args):
         cmd = self.cmdProbe
-        if self.context.debug: self.context.log(self.name, cmd.name)
+        if self.context.debug: self.context.logDebug(self.name, cmd.name)
 
     # ack command
     def handleAck(self, args):
         cmd = self.cmdAck
         if args != self.lastAck:       # only display changed values
             self.lastAck = args
-            if self.context.debugAck and self.context.monitorMode: self.context.log(self.name, cmd.name, args.encode("hex"))
+            if self.context.debugAck and self.context.monitorMode: self.context.logDebug(self.name, cmd.name, self.context.hex(args))
 
     # status command
     def handleStatus(self, args):
         cmd = self.cmdStatus
         if args != self.lastStatus:    # only display changed values
             self.lastStatus = args
-            if self.context.debugStatus: self.context.log(self.name, cmd.name, args.encode("hex"))
+            if self.context.debugStatus: self.context.logDebug(self.name, cmd.name, self.context.hex(args))
         self.statusEvent.set()
 
     # message command
     def handleMsg(self, args):
         cmd = self.cmdMsg
-        if self.context.debugMsg: self.context.log(self.name, cmd.name, args.encode("hex"))
+        if self.context.debugMsg: self.context.logDebug(self.name, cmd.name, self.context.hex(args))
         
 class Button(object):
     def __init__(self, theName, theCode):
@@ -100,35 +125,241 @@ class Command(object):
         self.argLen = theArgLen
 
 ########################################################################################################
-# action thread
+# action executor
 ########################################################################################################
-class ActionThread(threading.Thread):
-    # An ActionThread executes a sequence of actions
-    def __init__(self, theName, theContext, theSequence, thePanel):
-        threading.Thread.__init__(self, target=self.doAction)
+
+# action priorities
+priorityHigh = 0
+priorityNormal = 1
+priorityLow = 2
+
+class AckSlot(object):
+    # An AckSlot is an address a panel answers polls on, with the button to be sent in its next ack.
+    # A controller keeps a separate menu state for each keypad address, so only the primary slot
+    # parses messages other than status and is used to navigate the menus.
+    def __init__(self, theAddr, thePanel, thePrimary):
+        self.addr = theAddr
+        self.panel = thePanel
+        self.primary = thePrimary
+        self.button = thePanel.btnNone                 # current button pressed
+        self.ackEvent = threading.Event()              # an ack with a button has been sent
+        self.parseMsg = thePanel.parseMsg if thePrimary else thePanel.parseStatus
+
+    # return the button to be sent in the next ack and the encoded ack message
+    # the ack is logged by the interface after it has been sent
+    def getAck(self):
+        button = self.button
+        panel = self.panel
+        try:
+            frame = panel.ackFrames[button.code]
+        except KeyError:
+            frame = panel.pool.encoder.ackFrame(panel.cmdAck.code, panel.ack, button.code)
+            panel.ackFrames[button.code] = frame
+        if button is not panel.btnNone:
+            self.button = panel.btnNone
+            self.ackEvent.set()
+        return (button, frame)
+
+class ActionExecutor(threading.Thread):
+    # An ActionExecutor performs the action sequences requested for a panel one at a time,
+    # in order of priority and then in the order they were requested.
+    # A sequence is a list of stages.  A stage is a single Action, or a list of Actions that
+    # don't depend on each other.  The buttons of a stage are sent in the acks of consecutive
+    # polls, then the executor waits for the events that correspond to their completion,
+    # and then for the next status message before the next stage.
+    # If the panel answers on more than one address, consecutive actions of a stage that may be
+    # sent from any address are sent in the acks of different addresses at the same time.
+    # A sequence is performed by a task, which runs in the executor thread, or in the event
+    # loop if the executor is attached to one.
+    def __init__(self, theName, theContext, thePanel):
+        threading.Thread.__init__(self, target=self.doActions)
         self.name = theName
         self.context = theContext
-        self.sequence = theSequence
         self.panel = thePanel
-        # Clear all the events before starting.
-        for action in self.sequence:
-            action.event.clear()
-
-    def doAction(self):
-        if self.context.debugAction: self.context.log(self.name, "action started")
-        for action in self.sequence:
-            if not self.context.running: break
-            self.panel.button = action.button # set the button to be sent to start the action
-            if self.context.debugAction: self.context.log(self.name, "button", action.button.name, "sent")
-            action.event.wait()              # wait for the event that corresponds to the completion
-            if self.context.debugAction: self.context.log(self.name, "button", action.button.name, "completed")
-            time.sleep(1)
-        if self.context.debugAction: self.context.log(self.name, "action completed")
+        self.queue = Queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.loop = None
+        self.task = None            # task of the sequence being performed in the event loop
+        metrics = self.panel.pool.metrics
+        self.queueToAck = metrics.histogram("aqualink_action_ack_seconds",
+                                "Time from requesting an action sequence to the ack of its first button")
+        self.ackToStatus = metrics.histogram("aqualink_action_status_seconds",
+                                "Time from the ack of a button to the status or message that completes it")
+
+    def submit(self, theName, theSequence, thePriority=priorityNormal):
+        # request a sequence of actions and return an ActionFuture for its completion
+        future = ActionFuture(theName)
+        if self.context.debugAction: self.context.logDebug(theName, "action requested")
+        self.queue.put((thePriority, next(self.counter), theSequence, future))
+        if self.loop:
+            self.loop.callSoonThreadsafe(self.nextSequence)
+        return future
+
+    def attach(self, theLoop):
+        # perform the sequences in an event loop instead of starting the thread
+        self.loop = theLoop
+        self.loop.callSoonThreadsafe(self.nextSequence)
+
+    def nextSequence(self):
+        # start the next sequence in the event loop if none is being performed
+        if (self.task is not None) or not self.loop.running:
+            return
+        try:
+            (priority, count, sequence, future) = self.queue.get_nowait()
+        except Queue.Empty:
+            return
+        self.task = self.loop.startTask(self.doSequence(future, sequence),
+                                        lambda result: self.sequenceDone(future, result))
+
+    def sequenceDone(self, future, result):
+        self.task = None
+        future.setResult(result)
+        self.nextSequence()
+
+    def doActions(self):
+        if self.context.debug: self.context.logDebug(self.name, "starting action executor")
+        while self.context.running:
+            try:
+                (priority, count, sequence, future) = self.queue.get(True, 0.5)
+            except Queue.Empty:
+                continue
+            future.setResult(runTask(self.doSequence(future, sequence)))
+        self.cancel()
+        if self.context.debug: self.context.logDebug(self.name, "terminating action executor")
+
+    def cancel(self):
+        # cancel the actions that were not performed
+        try:
+            while True:
+                (priority, count, sequence, future) = self.queue.get_nowait()
+                future.setResult(False)
+        except Queue.Empty:
+            pass
+
+    # the sequence and stage tasks yield Waits for the panel events and finally their results
+    def doSequence(self, future, sequence):
+        if self.context.debugAction: self.context.logDebug(future.name, "action started")
+        future.startTime = time.time()
+        for stage in sequence:
+            if not self.context.running: 
+                yield False
+            if isinstance(stage, Action):
+                stage = [stage]
+            if not (yield self.doStage(future, [action for action in stage if action.needed()])):
+                yield False
+        if self.context.debugAction: self.context.logDebug(future.name, "action completed")
+        yield True
+
+    def doStage(self, future, stage):
+        if not stage:
+            yield True
+        panel = self.panel
+        slots = panel.slots
+        timeout = self.context.actionTimeout
+        # an action repeated in a stage, such as a held arrow button, completes once for all its presses
+        actions = []
+        for action in stage:
+            if action not in actions:
+                actions.append(action)
+                action.event.clear()
+        i = 0
+        while i < len(stage):
+            # the next action, or as many consecutive actions as there are slots that can use any of them
+            n = 1
+            if stage[i].anySlot:
+                while (n < len(slots)) and (i+n < len(stage)) and stage[i+n].anySlot:
+                    n += 1
+            batch = zip(slots, stage[i:i+n])
+            i += n
+            for (slot, action) in batch:
+                slot.ackEvent.clear()
+                slot.button = action.button    # set the button to be sent to start the action
+                if self.context.debugAction: self.context.logDebug(future.name, "button", action.button.name, "sent",
+                                                                   "from", "%02x"%ord(slot.addr))
+            for (slot, action) in batch:
+                if not (yield Wait(slot.ackEvent, timeout)):
+                    for other in slots:
+                        other.button = panel.btnNone
+                    if self.context.debugAction: self.context.logDebug(future.name, "button", action.button.name, "not acked")
+                    yield False
+                if self.context.metricsEnabled:
+                    action.ackTime = time.time()
+                    if future.ackTime is None:
+                        future.ackTime = action.ackTime
+                        self.queueToAck.observe(future.ackTime - future.submitTime)
+        for action in actions:
+            # wait for the event that corresponds to the completion
+            # it is set by any change, so wait again if an out of order status set it too soon
+            deadline = time.time() + timeout
+            while True:
+                if not (yield Wait(action.event, max(deadline - time.time(), 0))):
+                    if self.context.debugAction: self.context.logDebug(future.name, "button", action.button.name, "timed out")
+                    yield False
+                action.event.clear()
+                if action.completed():
+                    break
+            if self.context.metricsEnabled: self.ackToStatus.observe(time.time() - action.ackTime)
+            if self.context.debugAction: self.context.logDebug(future.name, "button", action.button.name, "completed")
+        # let the controller send its next status before the next stage
+        panel.statusEvent.clear()
+        yield Wait(panel.statusEvent, timeout)
+        yield True
+
+class ActionFuture(object):
+    # An ActionFuture is the result of a requested action sequence.
+    # The result is True if the sequence completed, and False if it timed out or was cancelled.
+    def __init__(self, theName):
+        self.name = theName
+        self.result = None
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.submitTime = time.time()
+        self.startTime = None
+        self.ackTime = None         # time the first button was acked
+        self.endTime = None
+
+    def done(self):
+        return self.event.isSet()
+
+    def wait(self, timeout=None):
+        # wait for the sequence to complete and return the result, or None if the wait timed out
+        self.event.wait(timeout)
+        return self.result
+
+    def addCallback(self, callback):
+        # call a function with this future when the sequence completes
+        with self.lock:
+            if not self.event.isSet():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def setResult(self, result):
+        with self.lock:
+            self.result = result
+            self.endTime = time.time()
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for callback in callbacks:
+            callback(self)
 
 class Action(object):
     # An Action consists of a command and an event.
     # When an Action is executed, the command is sent and the event is set when the command is complete.
+    anySlot = False         # True if the button may be sent from any address of the panel
+
     def __init__(self, theButton, theEvent):
         self.button = theButton
         self.event = theEvent
+        self.ackTime = None
+
+    def needed(self):
+        # returns False if the action no longer has to be performed when its turn comes
+        return True
+
+    def completed(self):
+        # returns True if the action is complete after its event has been set
+        return True
 
@@ -1,22 +1,33 @@
 #!/usr/bin/env python
 # coding=utf-8
 
+import os
 import time
+import threading
+import collections
 
 from interface import *
 from panel import *
 from allbuttonpanel import *
+from spasidepanel import *
+from history import *
+from metrics import *
+from profiler import *
+from eventloop import *
 
 ########################################################################################################
 # state of the pool and equipment
 ########################################################################################################
 class Pool(object):
     # constructor
-    def __init__(self, theName, theContext):
+    def __init__(self, theName, theContext, theLoop=None):
         self.name = theName
         self.context = theContext
         self.stateChanged = True
-        self.stateFileName = "pool.dat"
+        self.stateFileName = self.context.stateFileName
+        self.stateLock = threading.Lock()
+        self.dirty = set()          # names of the state values changed since the state was written
+        self.listeners = []         # functions called with the names of changed state values
 
         # identity
         self.model = ""
@@ -67,31 +78,127 @@ class Pool(object):
 
         # Modes
         self.cleanMode = Mode("Clean Mode", self.context, self, 
-                              [self.pump, self.aux1])
+                              [self.pump, self.aux1], {self.aux1: [self.pump]})
         self.spaMode = Mode("Spa Mode", self.context, self, 
-                            [self.spa, self.heater, self.aux4, self.aux5])
+                            [self.spa, self.heater, self.aux4, self.aux5], {self.heater: [self.spa]})
         self.lightsMode = Mode("Lights Mode", self.context, self, 
                               [self.aux4, self.aux5])
+        self.modeList = [self.cleanMode, self.spaMode, self.lightsMode]
+
+        # state values written to the state file
+        self.stateNames = ["model", "rev", "title", "tempScale", "airTemp", "poolTemp", "spaTemp"]
+
+        # equipment is identified in the state file by its attribute name
+        for (key, value) in vars(self).items():
+            if isinstance(value, Equipment):
+                value.key = key
+
+        # names whose changes make the state file be written
+        self.savedNames = set(self.stateNames + [equip.key for equip in self.equipList + self.modeList])
+
+        # state values reported to clients
+        self.valueNames = ["model", "rev", "title", "date", "time", "tempScale", "airTemp", "poolTemp", "spaTemp"] +\
+                          [equip.key for equip in self.equipList + self.modeList]
 
         # restore state
         self.readState()
+
+        # readers use the current snapshot of the state values, which is replaced on every change
+        self.Snapshot = collections.namedtuple("PoolSnapshot", ["version", "timestamp"] + self.valueNames)
+        self.snapshot = self.Snapshot(0, time.time(), *[self.stateValue(name) for name in self.valueNames])
+
+        # history of temperatures and equipment states
+        self.historyNames = ["airTemp", "poolTemp", "spaTemp"] + [equip.key for equip in self.equipList + self.modeList]
+        self.history = None
+        if self.context.historyFileName != "":
+            if historyAvailable:
+                self.history = History("History", self.context, self.historyNames,
+                                       self.context.historyFileName, self.context.historySize)
+                self.addListener(self.addHistory)
+            else:
+                self.context.logWarning(self.name, "history disabled, numpy is not installed")
                
+        # metrics of the interface, panels and actions
+        self.metrics = Metrics("Metrics", self.context)
+        self.metrics.gauge("aqualink_log_drops_total", "Log messages dropped because the log queue was full",
+                           lambda: self.context.logger.drops, "counter")
+
+        # profiler of the message handlers
+        self.profiler = Profiler("Profiler", self.context)
+
+        # messages and actions are handled by one event loop thread instead of a thread each if requested
+        # the loop may be shared with other pools
+        self.ownLoop = theLoop is None
+        self.loop = theLoop if theLoop else (EventLoop("Loop", self.context) if self.context.eventLoop else None)
+
         # initiate interface and panels
+        self.encoder = FrameEncoder()
         self.master = Panel("Master", self.context, self)
-        self.allButtonPanel = AllButtonPanel("All Button", self.context, self)
-        self.panels = {self.context.allButtonPanelAddr: self.allButtonPanel}
-        self.panel = self.panels.values()[0]
+        self.panels = {}                    # emulated panels indexed by address
+        self.panelList = []
+        self.panelTable = [None] * 256      # ack slots of the emulated panels indexed by address value
+        self.allButtonPanel = self.addPanel(self.context.allButtonPanelAddr+self.context.allButtonExtraAddrs,
+                                            AllButtonPanel("All Button", self.context, self))
+        if self.context.spaSidePanelAddr != "":
+            self.spaSidePanel = self.addPanel(self.context.spaSidePanelAddr,
+                                              SpaSidePanel("Spa Side", self.context, self))
+        # equipment is controlled from the All Button panel
+        self.panel = self.allButtonPanel
         self.interface = Interface("RS485", self.context, self)
 
         # get control sequences for equipment from the panel
         for equip in self.equipList:
             equip.action = self.panel.getAction(equip)
 
+    def addPanel(self, addrs, panel):
+        # emulate a panel at one or more addresses, the first one is its primary address
+        for addr in addrs:
+            self.panels[addr] = panel
+            self.panelTable[ord(addr)] = panel.addSlot(addr)
+        self.panelList.append(panel)
+        panel.buildAckFrames()
+        return panel
+
+    def start(self):
+        # start writing changes to the state file
+        self.stateWriter = StateWriter("State", self.context, [self])
+        self.stateWriter.start()
+
+        # profile the read thread on request
+        self.profiler.installSignal()
+
+        self.startReading()
+
+    def startReading(self):
+        # start performing actions
+        for panel in self.panelList:
+            if self.loop:
+                panel.executor.attach(self.loop)
+            else:
+                panel.executor.start()
+
+        # start reading messages from the controller
+        self.interface.start()
+        if self.loop and self.ownLoop:
+            loopThread = threading.Thread(target=self.runLoop, name="Loop")
+            loopThread.start()
+
         # start cron thread
         # this will prevent the program from exiting - FIXME
 #        cronThread = threading.Thread(target=self.doCron)
 #        cronThread.start()
 
+    def runLoop(self):
+        self.loop.run()
+        self.loopDone()
+
+    def loopDone(self):
+        # cancel the actions that were not performed
+        for panel in self.panelList:
+            panel.executor.cancel()
+        # finish a profile that is being captured
+        if self.profiler.captureProfile: self.profiler.update()
+
     def readState(self):
         try:
             inFile = open(self.stateFileName)
@@ -99,23 +206,70 @@ class Pool(object):
                 try:
                     line = line[:line.find("#")].strip()
                     if line != "":
-                        param = line.split("=")
-                        setattr(self, param[0].strip(), eval(param[1].strip()))
+                        param = line.split("=", 1)
+                        name = param[0].strip()
+                        # equipment state is always read from the controller
+                        if "." not in name:
+                            setattr(self, name, eval(param[1].strip()))
                 except:
                     pass
             inFile.close()
         except:
             pass
 
+    def changed(self, *names):
+        # record that state values have changed so the saved ones will be written, publish a new
+        # snapshot, and tell the listeners
+        with self.stateLock:
+            saved = [name for name in names if name in self.savedNames]
+            if saved:
+                self.dirty.update(saved)
+                self.stateChanged = True
+            values = dict((name, self.stateValue(name)) for name in names if name in self.snapshot._fields)
+            snapshot = self.snapshot._replace(version=self.snapshot.version+1, timestamp=time.time(), **values)
+            self.snapshot = snapshot
+        for listener in self.listeners:
+            listener(snapshot, names)
+
+    def addListener(self, listener):
+        # call a function with the new snapshot and the names of the state values whenever they change
+        # it is called from the thread that made the change and must not block
+        self.listeners.append(listener)
+
+    def addHistory(self, snapshot, names):
+        values = dict((name, getattr(snapshot, name)) for name in names if name in self.history.metrics)
+        if values:
+            self.history.add(snapshot.timestamp, values)
+
+    def stateValue(self, name):
+        # return a state value, or the state of a piece of equipment
+        value = getattr(self, name)
+        return value.state if isinstance(value, Equipment) else value
+
+    def stateDict(self, snapshot, names=None):
+        # return a dictionary of state values from a snapshot
+        return dict((name, getattr(snapshot, name)) for name in (self.valueNames if names is None else names))
+
     def writeState(self):
-        if self.stateChanged:
-            stateFile = open(self.stateFileName, "w")
-            stateFile.write("title = '"+self.title+"'\n")
-            stateFile.write("airTemp = "+str(self.airTemp)+"\n")
-            stateFile.write("poolTemp = "+str(self.poolTemp)+"\n")
-            stateFile.write("spaTemp = "+str(self.spaTemp)+"\n")
-            stateFile.close()
+        # write the state to a temporary file and rename it so the state file is always complete
+        with self.stateLock:
+            if not self.stateChanged:
+                return
+            snapshot = self.snapshot
+            state = [(name, getattr(snapshot, name)) for name in self.stateNames] +\
+                    [(equip.key+".state", getattr(snapshot, equip.key)) for equip in self.equipList + self.modeList]
+            if self.context.debug: self.context.logDebug(self.name, "writing state", *sorted(self.dirty))
+            self.dirty.clear()
             self.stateChanged = False
+        tmpFileName = self.stateFileName+".tmp"
+        stateFile = open(tmpFileName, "w")
+        stateFile.write("# "+time.strftime("%Y-%m-%d %H:%M:%S")+"\n")
+        for (name, value) in state:
+            stateFile.write(name+" = "+repr(value)+"\n")
+        stateFile.flush()
+        os.fsync(stateFile.fileno())
+        stateFile.close()
+        os.rename(tmpFileName, self.stateFileName)
                 
     def doCron(self):
         while True:
@@ -124,80 +278,100 @@ class Pool(object):
             time.sleep(3600)
         
     def checkTime(self):
+        # set the controller clock if it is off by more than the threshold
+        # returns the ActionFuture of the adjustment, or None
         if (self.date != "") and (self.time != ""):
-            realTime = time.localtime()
             poolTime = time.strptime(self.date+self.time, '%m/%d/%y %a%I:%M %p')
-            diffTime = (realTime.tm_year - poolTime.tm_year,
-                        realTime.tm_mon - poolTime.tm_mon,
-                        realTime.tm_mday - poolTime.tm_mday,
-                        realTime.tm_hour - poolTime.tm_hour,
-                        realTime.tm_min - poolTime.tm_min - 1)
-            # need to deal with cases where changing a field rolls over the next field
-            # e.g. 3:59 incremented by 2 minutes - FIXME
-            if diffTime != (0, 0, 0, 0, 0):
-                self.context.log("controller time", time.asctime(poolTime))
-                self.context.log("adjusting to", time.asctime(realTime))
-                self.panel.adjustTime(diffTime)
+            drift = time.time() - time.mktime(poolTime)
+            if abs(drift) > self.context.clockDriftThreshold:
+                self.context.log("controller time", time.asctime(poolTime), "off by", "%d"%drift, "seconds")
+                (future, presses, duration) = self.panel.adjustTime(poolTime)
+                self.context.log("adjusting clock", presses, "presses", "predicted", "%.1f"%duration, "seconds")
+                return future
+        return None
 
     def setModel(self, model, rev=""):
         if model != self.model:
             self.model = model
             self.rev = rev
-            self.stateChanged = True
-        self.writeState()        
+            self.changed("model", "rev")
 
     def setTitle(self, title):
         if title != self.title:
             self.title = title
-            self.stateChanged = True
-        self.writeState()        
+            self.changed("title")
 
     def setDate(self, theDate):
         if theDate != self.date:
             self.date = theDate
-            self.stateChanged = True
-        self.writeState()        
+            self.changed("date")
 
     def setTime(self, theTime):
         if theTime != self.time:
             self.time = theTime
-            self.stateChanged = True
-        self.writeState()        
+            self.changed("time")
         
     def setAirTemp(self, temp):
         if temp[0] != self.airTemp:
             self.airTemp = temp[0]
             self.tempScale = temp[1]
-            self.stateChanged = True
-        self.writeState()        
+            self.changed("airTemp", "tempScale")
                     
     def setPoolTemp(self, temp):
         if temp[0] != self.poolTemp:
             self.poolTemp = temp[0]
             self.tempScale = temp[1]
-            self.stateChanged = True
-        self.writeState()        
+            self.changed("poolTemp", "tempScale")
         
     def setSpaTemp(self, temp):
         if temp[0] != self.spaTemp:
             self.spaTemp = temp[0]
             self.tempScale = temp[1]
-            self.stateChanged = True
-        self.writeState()        
+            self.changed("spaTemp", "tempScale")
 
     def printState(self, start="", end="\n"):
-        msg  = start+"Title:      "+self.title+end
-        msg += start+"Model:      "+self.model+" Rev "+self.rev+end
-        msg += start+"Date:       "+self.date+end
-        msg += start+"Time:       "+self.time+end
-        msg += start+"Air Temp:    %d°%s" %  (self.airTemp, self.tempScale)+end
-        msg += start+"Pool Temp:   %d°%s" %  (self.poolTemp, self.tempScale)+end
-        msg += start+"Spa Temp:    %d°%s" %  (self.spaTemp, self.tempScale)+end
+        snapshot = self.snapshot
+        msg  = start+"Title:      "+snapshot.title+end
+        msg += start+"Model:      "+snapshot.model+" Rev "+snapshot.rev+end
+        msg += start+"Date:       "+snapshot.date+end
+        msg += start+"Time:       "+snapshot.time+end
+        msg += start+"Air Temp:    %d°%s" %  (snapshot.airTemp, snapshot.tempScale)+end
+        msg += start+"Pool Temp:   %d°%s" %  (snapshot.poolTemp, snapshot.tempScale)+end
+        msg += start+"Spa Temp:    %d°%s" %  (snapshot.spaTemp, snapshot.tempScale)+end
         for equip in self.equipList:
             if equip.name != "":
-                msg += start+"%-12s"%(equip.name+":")+equip.printState()+end
+                msg += start+"%-12s"%(equip.name+":")+stateName(getattr(snapshot, equip.key))+end
+        for mode in self.modeList:
+            msg += start+"%-12s"%(mode.name+": ")+stateName(getattr(snapshot, mode.key))+\
+                   (" (%.1fs)"%mode.latency if mode.latency is not None else "")+end
         return msg
 
+class StateWriter(threading.Thread):
+    # writes the state and history of one or more pools when they have changed, at most once per interval
+    # and when the program stops
+    def __init__(self, theName, theContext, thePools):
+        threading.Thread.__init__(self, target=self.doWrite)
+        self.name = theName
+        self.context = theContext
+        self.pools = thePools
+
+    def doWrite(self):
+        if self.context.debug: self.context.logDebug(self.name, "starting state writer")
+        lastWrite = time.time()
+        while self.context.running:
+            time.sleep(0.5)
+            if time.time() - lastWrite >= self.context.stateWriteInterval:
+                self.write()
+                lastWrite = time.time()
+        self.write()
+        if self.context.debug: self.context.logDebug(self.name, "terminating state writer")
+
+    def write(self):
+        for pool in self.pools:
+            pool.writeState()
+            if pool.history:
+                pool.history.flush()
+
 class Equipment(object):
     # equipment states
     stateOff = 0
@@ -211,60 +385,102 @@ class Equipment(object):
         self.pool = thePool
         self.action = theAction
         self.state = Equipment.stateOff
+        self.key = ""
 
     def setState(self, newState):
         # sets the state of the equipment object, not the actual equipment
         self.state = newState
-        self.pool.stateChanged = True
+        self.pool.changed(self.key)
         self.context.log(self.name, self.printState())
 
     def printState(self):
-        if self.state == Equipment.stateOn: return "ON"
-        elif self.state == Equipment.stateEna: return "ENA"
-        elif self.state == Equipment.stateEnh: return "ENH"
-        else: return "OFF"
+        return stateName(self.state)
 
     def changeState(self, newState, wait=False):
         # turns the equipment on or off
-        if self.context.debug: log(self.name, self.state, newState)
-        if ((newState == Equipment.stateOn) and (self.state == Equipment.stateOff)) or\
-           ((newState == Equipment.stateOff) and (self.state != Equipment.stateOff)):
-            action = ActionThread(self.name+(" On" if newState else " Off"), 
-                            self.pool.context, [self.action], self.pool.panel)
-            action.start()
+        # returns an ActionFuture that completes when the controller reports the change
+        if self.context.debug: self.context.logDebug(self.name, self.state, newState)
+        if self.needsChange(newState):
+            future = self.pool.panel.executor.submit(self.name+(" On" if newState else " Off"), 
+                                                     [StateAction(self, newState)])
             if wait:
-                self.action.event.wait()
+                future.wait()
+        else:
+            # nothing to do
+            future = ActionFuture(self.name)
+            future.setResult(True)
+        return future
+
+    def needsChange(self, newState):
+        # returns True if the equipment has to be turned on or off to be in the new state
+        return ((newState == Equipment.stateOn) and (self.state == Equipment.stateOff)) or\
+               ((newState == Equipment.stateOff) and (self.state != Equipment.stateOff))
 
 class Mode(Equipment):
-    # a Mode is defined by an ordered list of Equipment that is turned on or off
-    def __init__(self, name, theContext, thePool, theEquipList):
+    # a Mode is defined by a list of Equipment that is turned on or off
+    # the dependencies map a piece of equipment to the equipment that must be turned on before it
+    # equipment that doesn't depend on anything that hasn't been turned on yet is turned on
+    # at the same time, and equipment is turned off in the reverse order
+    def __init__(self, name, theContext, thePool, theEquipList, theDependencies={}):
         Equipment.__init__(self, name, theContext, thePool)
         self.equipList = theEquipList
+        self.dependencies = theDependencies
+        self.latency = None         # seconds the last change took to complete
+        # group the equipment into stages that only depend on earlier stages
+        level = {}
+        def getLevel(equip):
+            if equip not in level:
+                level[equip] = 1 + max([getLevel(dep) for dep in self.dependencies.get(equip, [])
+                                        if dep in self.equipList] + [-1])
+            return level[equip]
+        nStages = 1 + max([getLevel(equip) for equip in self.equipList] + [-1])
+        self.stages = [[equip for equip in self.equipList if level[equip] == stage] for stage in range(nStages)]
 
     def changeState(self, newState=None):
         # turns the list of equipment on or off
-        if self.context.debugAction: self.context.log(self.name, self.state, newState)
+        # returns an ActionFuture that completes when all the equipment has changed
+        if self.context.debugAction: self.context.logDebug(self.name, self.state, newState)
         if newState != None:
             self.newState = newState
         else:
             # toggle if new state is not specified
             self.newState = not self.state
-        # do the work in a thread so this function returns asynchronously
-        modeThread = threading.Thread(target=self.doMode)
-        modeThread.start()
-
-    def doMode(self):
-        if self.context.debugAction: self.context.log(self.name, "mode started", self.newState)
         if self.newState == Equipment.stateOn:
-            # turn on equipment list in order
-            for equip in self.equipList:
-                equip.changeState(self.newState, wait=True)
+            # turn on the stages in order
+            stages = self.stages
         else:
-            # turn off equipment list in reverse order
-             for equip in reversed(self.equipList):
-                equip.changeState(self.newState, wait=True)
-        if self.context.debugAction: self.context.log(self.name, "mode completed")
-        self.state = self.newState
-        self.context.log(self.name, self.printState())
-                
-            
+            # turn off the stages in reverse order
+            stages = reversed(self.stages)
+        sequence = [[StateAction(equip, self.newState) for equip in stage] for stage in stages]
+        future = self.pool.panel.executor.submit(self.name, sequence)
+        future.addCallback(self.modeDone)
+        return future
+
+    def modeDone(self, future):
+        self.latency = future.endTime - future.submitTime
+        if self.context.debugAction: self.context.logDebug(self.name, "mode completed", future.result, "in", "%.3f"%self.latency, "seconds")
+        if future.result:
+            self.setState(self.newState)
+
+class StateAction(Action):
+    # a StateAction turns a piece of equipment on or off if it is not already in that state when it is performed
+    # the equipment buttons don't depend on the menu state, so they can be pressed from any address
+    anySlot = True
+
+    def __init__(self, theEquip, theState):
+        Action.__init__(self, theEquip.action.button, theEquip.action.event)
+        self.equip = theEquip
+        self.state = theState
+
+    def needed(self):
+        return self.equip.needsChange(self.state)
+
+    def completed(self):
+        return not self.equip.needsChange(self.state)
+
+def stateName(state):
+    # returns the name of an equipment state
+    if state == Equipment.stateOn: return "ON"
+    elif state == Equipment.stateEna: return "ENA"
+    elif state == Equipment.stateEnh: return "ENH"
+    else: return "OFF"
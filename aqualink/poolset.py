@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+import threading
+import collections
+
+from pool import *
+from BTUtils import BTContext
+from gatewayport import isSocketName
+
+# files each pool has its own of, named by default like the application's with the pool id added
+poolFiles = ["stateFileName", "historyFileName", "profileFileName", "captureFile", "sniffOutput"]
+
+########################################################################################################
+# several pools in one process
+########################################################################################################
+class PoolSet(object):
+    """ Several pools run by one process.
+
+    context.pools maps a pool id to a configuration file whose values override the
+    application configuration for that pool, so each pool has its own RS485 device,
+    panel addresses, and state and history files.  The files that aren't set for a
+    pool default to the application's with the pool id added, pool.dat becomes
+    pool_north.dat, so pools never share one.  Each pool has its own read path,
+    panels and state.  The pools share the log and one state writer thread, and if
+    eventLoop is set, one event loop thread reads the messages and performs the
+    actions of all of them.
+    """
+    def __init__(self, theName, theContext):
+        self.name = theName
+        self.context = theContext
+        self.loop = EventLoop("Loop", self.context) if self.context.eventLoop else None
+        self.pools = collections.OrderedDict()      # pools indexed by id
+        for poolId in sorted(self.context.pools.keys()):
+            poolContext = BTContext(poolId, self.context, self.context.pools[poolId], self.poolFiles(poolId))
+            self.pools[poolId] = Pool("Pool", poolContext, self.loop)
+        self.context.log(self.name, "pools", *self.pools.keys())
+
+    def poolFiles(self, poolId):
+        # the default names of the files of a pool
+        files = {}
+        for name in poolFiles:
+            fileName = getattr(self.context, name)
+            if fileName and not isSocketName(fileName):
+                (root, ext) = os.path.splitext(fileName)
+                files[name] = root+"_"+poolId+ext
+        return files
+
+    def start(self):
+        # start writing changes to the state files
+        self.stateWriter = StateWriter("State", self.context, self.pools.values())
+        self.stateWriter.start()
+
+        for pool in self.pools.values():
+            # profile the read threads on request, a shared loop is profiled once for all the pools
+            if not self.loop or (pool is self.pools.values()[0]):
+                pool.profiler.installSignal()
+            pool.startReading()
+        if self.loop:
+            loopThread = threading.Thread(target=self.runLoop, name="Loop")
+            loopThread.start()
+
+    def runLoop(self):
+        self.loop.run()
+        for pool in self.pools.values():
+            pool.loopDone()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import signal
+import cProfile
+import threading
+
+from capture import monotonic, clockGettime, clockThreadCpu
+
+signalProfilers = []        # profilers that capture when the program receives SIGUSR1
+threadCaptures = {}         # profiler capturing in each thread, cProfile can only run one at a time
+
+def threadTime():
+    """ Return the CPU time used by the calling thread in seconds."""
+    return clockGettime(clockThreadCpu)
+
+class Profiler(object):
+    """ Message handler profiler.
+
+    Every call of a panel message handler is counted, and one call in
+    context.profileInterval is timed, so it can be left on.  A cProfile capture of
+    the read thread for a number of seconds can be requested from any thread or with
+    SIGUSR1; the read thread starts and stops it and writes the profile to
+    context.profileFileName, which can be read with pstats or converted to a
+    flame graph.  Only one capture runs in a thread at a time, so when pools share
+    an event loop a request made while another pool is being captured is dropped.
+    """
+    def __init__(self, theName, theContext):
+        self.name = theName
+        self.context = theContext
+        self.stats = {}             # HandlerStats indexed by panel name and handler name
+        self.pending = False        # a capture has been requested or is running
+        self.captureWindow = 0.0
+        self.captureProfile = None
+        self.captureEnd = 0.0
+
+    def call(self, handler, panel, args):
+        """ Call a message handler and record its statistics."""
+        key = (panel.name, handler.__name__)
+        try:
+            stats = self.stats[key]
+        except KeyError:
+            stats = HandlerStats()
+            self.stats[key] = stats
+        stats.calls += 1
+        if stats.calls % self.context.profileInterval:
+            handler(panel, args)
+            return
+        startWall = monotonic()
+        startCpu = threadTime()
+        handler(panel, args)
+        cpu = threadTime() - startCpu
+        wall = monotonic() - startWall
+        stats.samples += 1
+        stats.wallTime += wall
+        stats.cpuTime += cpu
+        if wall > stats.maxWall:
+            stats.maxWall = wall
+
+    def format(self):
+        """ Return a table of the handler statistics."""
+        lines = ["%-12s %-16s %10s %8s %12s %12s %12s\n" %
+                 ("panel", "handler", "calls", "samples", "wall us", "cpu us", "max wall us")]
+        for ((panelName, handlerName), stats) in sorted(self.stats.items()):
+            samples = max(stats.samples, 1)
+            lines.append("%-12s %-16s %10d %8d %12.1f %12.1f %12.1f\n" %
+                         (panelName, handlerName, stats.calls, stats.samples, stats.wallTime / samples * 1e6,
+                          stats.cpuTime / samples * 1e6, stats.maxWall * 1e6))
+        return "".join(lines)
+
+    def installSignal(self):
+        """ Request a capture when the program receives SIGUSR1, along with the other
+        profilers that installed it.  Must be called from the main thread."""
+        signalProfilers.append(self)
+        signal.signal(signal.SIGUSR1, requestCaptures)
+
+    def requestCapture(self, seconds):
+        """ Ask the read thread to profile itself for a number of seconds."""
+        if self.captureProfile is None:
+            self.captureWindow = seconds
+            self.pending = True
+
+    def update(self):
+        """ Start or stop a requested capture.  Called by the read thread while pending is set."""
+        if self.captureProfile is None:
+            thread = threading.currentThread()
+            if thread in threadCaptures:
+                self.context.logWarning(self.name, "read thread is already being profiled by",
+                                        threadCaptures[thread].context.profileFileName)
+                self.pending = False
+                return
+            threadCaptures[thread] = self
+            self.context.log(self.name, "profiling read thread for", self.captureWindow, "seconds")
+            self.captureEnd = monotonic() + self.captureWindow
+            self.captureProfile = cProfile.Profile()
+            self.captureProfile.enable()
+        elif (monotonic() >= self.captureEnd) or not self.context.running:
+            self.captureProfile.disable()
+            del threadCaptures[threading.currentThread()]
+            self.captureProfile.dump_stats(self.context.profileFileName)
+            self.context.log(self.name, "profile written to", self.context.profileFileName)
+            self.captureProfile = None
+            self.pending = False
+
+def requestCaptures(signum, frame):
+    for profiler in signalProfilers:
+        profiler.requestCapture(profiler.context.profileWindow)
+
+class HandlerStats(object):
+    """ Statistics of a message handler."""
+    __slots__ = ["calls", "samples", "wallTime", "cpuTime", "maxWall"]
+
+    def __init__(self):
+        self.calls = 0
+        self.samples = 0
+        self.wallTime = 0.0
+        self.cpuTime = 0.0
+        self.maxWall = 0.0
@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 # coding=utf-8
 
+import os
 import sys
 import serial
 import threading
 import struct
+import collections
 
 # configuration
 unitId = 0
@@ -32,10 +34,13 @@ class SerialUI(object):
                                           parity=serial.PARITY_NONE, 
                                           stopbits=serial.STOPBITS_ONE)
             except:
-                self.context.log(self.name, "unable to open serial port")
+                self.context.logError(self.name, "unable to open serial port")
                 return
         readRS232Thread = RS232Thread("RS232", self.context, inPort, outPort, self.pool)
-        readRS232Thread.start()
+        if self.pool.loop:
+            readRS232Thread.attach(self.pool.loop)
+        else:
+            readRS232Thread.start()
         self.context.log(self.name, "ready")
 
 class RS232Thread(threading.Thread):
@@ -49,6 +54,10 @@ class RS232Thread(threading.Thread):
         self.inPort = inPort
         self.outPort = outPort
         self.pool = thePool
+        self.loop = None
+        self.inData = ""                    # partial line read in the event loop
+        self.lines = collections.deque()    # lines waiting for the previous command to complete
+        self.deferred = None                # response of the command being completed
 
         self.product = "Pool Controller Serial Adapter Emulator"
         self.version = "A01"
@@ -164,7 +173,7 @@ class RS232Thread(threading.Thread):
     def readData(self):
         """ Message handling loop.
         Read messages from the interface and process the command."""
-        if self.context.debug: self.context.log(self.name, "starting RS232 read thread")
+        if self.context.debug: self.context.logDebug(self.name, "starting RS232 read thread")
         self.sendMsg("Ready")
         while self.context.running:
             # read until the program state changes to not running
@@ -174,11 +183,48 @@ class RS232Thread(threading.Thread):
                 if self.adapterState.echo:
                     self.sendMsg(msg)
                 self.sendMsg(self.parseMsg(msg))
-        if self.context.debug: self.context.log(self.name, "terminating RS232 read thread")
+        if self.context.debug: self.context.logDebug(self.name, "terminating RS232 read thread")
 
     def readMsg(self):
         """ Read the next message from the serial port."""
         return self.inPort.readline().strip("\n")
+
+    def attach(self, theLoop):
+        """ Read commands in an event loop instead of starting the thread.
+        A command that changes equipment is responded to when the change completes,
+        and the commands after it wait until then."""
+        self.loop = theLoop
+        self.sendMsg("Ready")
+        self.loop.addReader(self.inPort.fileno(), self.readReady)
+
+    def readReady(self):
+        data = os.read(self.inPort.fileno(), 4096)
+        if data == "":
+            self.loop.removeReader(self.inPort.fileno())
+            return
+        lines = (self.inData+data).split("\n")
+        self.inData = lines.pop()
+        self.lines.extend(lines)
+        self.nextMsg()
+
+    def nextMsg(self):
+        # handle the waiting lines until a response is deferred
+        while self.lines and not self.deferred:
+            msg = self.lines.popleft()
+            if msg != "":
+                if self.adapterState.echo:
+                    self.sendMsg(msg)
+                response = self.parseMsg(msg)
+                if isinstance(response, DeferredResponse):
+                    self.deferred = response
+                    response.future.addCallback(lambda future: self.loop.callSoonThreadsafe(self.deferredDone))
+                else:
+                    self.sendMsg(response)
+
+    def deferredDone(self):
+        self.sendMsg(self.deferred.response())
+        self.deferred = None
+        self.nextMsg()
                                
     def sendMsg(self, msg):
         n = self.outPort.write(msg+"\n")
@@ -206,16 +252,16 @@ class RS232Thread(threading.Thread):
         except:
             return self.error(2)
         try:
-            if self.context.debug: self.context.log(self.name, cmd, oper, value)
+            if self.context.debug: self.context.logDebug(self.name, cmd, oper, value)
             response = self.cmdTable[cmd](self, cmd, oper, value)
         except KeyError:
             if cmd[0:3] == "AUX":
                 auxDev = int(cmd[3:])
                 cmd = cmd[0:3]
-                if self.context.debug: self.context.log(self.name, cmd, oper, value)
+                if self.context.debug: self.context.logDebug(self.name, cmd, oper, value)
                 response = self.auxCmd(cmd, auxdev, oper, value)
             else:
-                if self.context.debug: self.context.log(self.name, "unknown", cmd)
+                if self.context.debug: self.context.logDebug(self.name, "unknown", cmd)
                 response = self.error(1)
         return response
 
@@ -300,7 +346,7 @@ class RS232Thread(threading.Thread):
         return self.response(cmd, "=", str(struct.unpack("!B", self.adapterState.errChr)[0]))
 
     def modelCmd(self, cmd, oper, value):
-        return self.response(cmd, "=", self.pool.model)
+        return self.response(cmd, "=", self.pool.snapshot.model)
 
     def opmodeCmd(self, cmd, oper, value):
         return self.response(cmd, "=", self.pool.opMode)
@@ -320,7 +366,9 @@ class RS232Thread(threading.Thread):
     def equipCmd(self, cmd, oper, value):
         if oper == "=":
             if int(value) in range(0,2):
-                self.equipTable[cmd].changeState(int(value), wait=True)
+                future = self.equipTable[cmd].changeState(int(value), wait=not self.loop)
+                if self.loop:
+                    return DeferredResponse(future, lambda: self.equipResponse(cmd))
             else:
                 return self.error(5)
         elif oper == "+":
@@ -328,7 +376,10 @@ class RS232Thread(threading.Thread):
                 return self.error(21)
             else:
                 return self.error(3)
-        return self.response(cmd, "=", self.equipState(self.equipTable[cmd].state))
+        return self.equipResponse(cmd)
+
+    def equipResponse(self, cmd):
+        return self.response(cmd, "=", self.equipState(getattr(self.pool.snapshot, self.equipTable[cmd].key)))
 
 #    def cleanrCmd(self, cmd, oper, value):
 #        return self.error(23)
@@ -348,9 +399,10 @@ class RS232Thread(threading.Thread):
         if oper == "=":
             if value in ["C", "F"]:
                 self.pool.tempScale = value
+                self.pool.changed("tempScale")
             else:
                 return self.error(5)
-        return self.response(cmd, "=", self.pool.tempScale)
+        return self.response(cmd, "=", self.pool.snapshot.tempScale)
 
     def poolhtCmd(self, cmd, oper, value):
         self.spahtCmd(self, cmd, oper, value)
@@ -376,13 +428,16 @@ class RS232Thread(threading.Thread):
         return self.error(18)
 
     def pooltmpCmd(self, cmd, oper, value):
-        return self.response(cmd, "=", str(self.pool.poolTemp)+self.pool.tempScale)
+        snapshot = self.pool.snapshot
+        return self.response(cmd, "=", str(snapshot.poolTemp)+snapshot.tempScale)
 
     def spatmpCmd(self, cmd, oper, value):
-        return self.response(cmd, "=", str(self.pool.spaTemp)+self.pool.tempScale)
+        snapshot = self.pool.snapshot
+        return self.response(cmd, "=", str(snapshot.spaTemp)+snapshot.tempScale)
 
     def airtmpCmd(self, cmd, oper, value):
-        return self.response(cmd, "=", str(self.pool.airTemp)+self.pool.tempScale)
+        snapshot = self.pool.snapshot
+        return self.response(cmd, "=", str(snapshot.airTemp)+snapshot.tempScale)
 
     def soltmpCmd(self, cmd, oper, value):
         return self.error(18)
@@ -418,6 +473,12 @@ class RS232Thread(threading.Thread):
         self.context.running = False
         return "Terminating"
         
+class DeferredResponse(object):
+    # the response to a command that is built when its action completes
+    def __init__(self, theFuture, theResponse):
+        self.future = theFuture
+        self.response = theResponse
+
 class AdapterState(object):
     def __init__(self):
         # default state
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+import tty
+import time
+import random
+import select
+import threading
+
+from interface import *
+
+########################################################################################################
+# Aqualink controller simulator
+########################################################################################################
+
+class Simulator(object):
+    """ Aqualink master controller simulator
+
+    Opens a pseudo-terminal and acts as the Aqualink controller on the master side of
+    it.  A program under test opens the slave side as its RS485 device.
+
+    Each simulated panel address is polled at its own rate.  The first poll of an
+    address is a probe, after that status messages alternate with text messages.  A
+    button code received in an ack toggles the LED status of the equipment it
+    controls, and is answered with a message so that menu actions complete.
+
+    Noise bytes and messages with bad checksums can be injected at a given rate.
+    """
+    def __init__(self, theName, theContext):
+        self.name = theName
+        self.context = theContext
+
+        # open the pseudo-terminal
+        (self.masterFd, self.slaveFd) = os.openpty()
+        tty.setraw(self.slaveFd)
+        self.slaveName = os.ttyname(self.slaveFd)
+        self.deviceName = self.slaveName
+        if self.context.simDevice != "":
+            if os.path.islink(self.context.simDevice):
+                os.remove(self.context.simDevice)
+            os.symlink(self.slaveName, self.context.simDevice)
+            self.deviceName = self.context.simDevice
+
+        self.encoder = FrameEncoder()
+        self.framer = Framer()
+
+        # commands
+        self.cmdProbe = '\x00'
+        self.cmdAck = '\x01'
+        self.cmdStatus = '\x02'
+        self.cmdMsg = '\x03'
+        self.cmdLongMsg = '\x04'
+
+        # controller state
+        self.status = 0x0000000000
+        self.model = "B0029221 REV T.2"
+        self.title = "SIMULATED POOL"
+        self.airTemp = 72
+        self.poolTemp = 80
+        self.spaTemp = 100
+        self.clockOffset = 0.0          # controller clock relative to the system clock
+
+        # status bits for each button, and the value the LED is set to when turned on
+        self.ledTable = {0x0a: (0xc000000000, 0x01),      # aux2
+                         0x0f: (0x3000000000, 0x01),      # aux3
+                         0x15: (0x0300000000, 0x01),      # aux7
+                         0x0b: (0x00c0000000, 0x01),      # aux5
+                         0x02: (0x0030000000, 0x01),      # pump
+                         0x01: (0x000c000000, 0x01),      # spa
+                         0x05: (0x0003000000, 0x01),      # aux1
+                         0x10: (0x0000c00000, 0x01),      # aux6
+                         0x06: (0x0000030000, 0x01),      # aux4
+                         0x17: (0x000000000f, 0x02),      # spa heater enabled
+                         0x12: (0x000000f000, 0x02),      # pool heater enabled
+                         0x1c: (0x00000000f0, 0x02)}      # solar heater enabled
+
+        # messages sent in response to the menu buttons
+        self.keyTable = {0x09: "MENU",
+                         0x0e: "CANCEL",
+                         0x13: "LEFT",
+                         0x18: "RIGHT",
+                         0x19: "HOLD",
+                         0x1e: "OVERRIDE",
+                         0x1d: "ENTER"}
+
+        # panels being polled
+        self.devices = []
+        for addr in sorted(self.context.simPanels.keys()):
+            self.devices += [SimDevice(addr, self.context.simPanels[addr])]
+
+        # statistics
+        self.nPolls = 0
+        self.nAcks = 0
+        self.nTimeouts = 0
+        self.nButtons = 0
+
+        self.context.log(self.name, "controller on", self.deviceName)
+
+    def start(self):
+        simThread = threading.Thread(target=self.run, name=self.name)
+        simThread.daemon = True
+        simThread.start()
+
+    def run(self):
+        """ Poll the panels until the program stops running."""
+        if self.context.debug: self.context.logDebug(self.name, "starting simulator")
+        now = time.time()
+        for device in self.devices:
+            device.nextPoll = now
+        while self.context.running:
+            # poll the device that is due next
+            device = min(self.devices, key=lambda d: d.nextPoll)
+            delay = device.nextPoll - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            device.nextPoll += device.interval
+            self.poll(device)
+        if self.context.debug: self.context.logDebug(self.name, "terminating simulator", "polls", self.nPolls,
+                                                     "acks", self.nAcks, "timeouts", self.nTimeouts, "buttons", self.nButtons)
+
+    def poll(self, device):
+        """ Send the next message to a device and handle its ack."""
+        self.nPolls += 1
+        (cmd, args) = self.nextMsg(device)
+        self.send(device.addr, cmd, args)
+        ack = self.readAck()
+        if ack is None:
+            self.nTimeouts += 1
+            device.probed = False
+            return
+        self.nAcks += 1
+        device.probed = True
+        buttonCode = ord(ack[1])
+        if buttonCode != 0:
+            self.pressButton(device, buttonCode)
+
+    def nextMsg(self, device):
+        """ Return the command and arguments of the next message for a device."""
+        if not device.probed:
+            return (self.cmdProbe, "")
+        if device.pending:
+            (cmd, args) = device.pending.pop(0)
+            if args is None:
+                # the status is the state when the message is sent, not when it was queued
+                args = self.statusArgs()
+            return (cmd, args)
+        device.count += 1
+        if device.count % 2 == 1:
+            return (self.cmdStatus, self.statusArgs())
+        msgs = self.messages()
+        msg = msgs[(device.count // 2 - 1) % len(msgs)]
+        return (self.cmdMsg, self.msgArgs(msg))
+
+    def messages(self):
+        """ Return the list of messages that are displayed in rotation."""
+        now = time.localtime(time.time() + self.clockOffset)
+        return [self.model,
+                "AIR TEMP %d\xdfF" % self.airTemp,
+                "POOL TEMP %d\xdfF" % self.poolTemp,
+                "SPA TEMP %d\xdfF" % self.spaTemp,
+                time.strftime("%m/%d/%y %a", now).upper(),
+                time.strftime("%I:%M %p", now),
+                self.title]
+
+    def statusArgs(self):
+        return "".join(byteChr[(self.status >> shift) & 0xff] for shift in (32, 24, 16, 8, 0))
+
+    def msgArgs(self, msg, line=0):
+        return byteChr[line] + msg[:16].ljust(16)
+
+    def pressButton(self, device, buttonCode):
+        """ Change the controller state for a button received in an ack."""
+        self.nButtons += 1
+        if self.context.debugAck: self.context.logDebug(self.name, "button", "%02x"%buttonCode, "from", "%02x"%ord(device.addr))
+        try:
+            (mask, value) = self.ledTable[buttonCode]
+            shift = 0
+            while not (mask >> shift) & 1:
+                shift += 1
+            if self.status & mask:
+                self.status &= ~mask
+                state = "OFF"
+            else:
+                self.status |= value << shift
+                state = "ON"
+            device.pending += [(self.cmdStatus, None),
+                               (self.cmdLongMsg, self.msgArgs("%02X %s" % (buttonCode, state)))]
+        except KeyError:
+            try:
+                device.pending += [(self.cmdMsg, self.msgArgs(self.keyTable[buttonCode]))]
+            except KeyError:
+                if self.context.debug: self.context.logDebug(self.name, "unknown button", "%02x"%buttonCode)
+
+    def send(self, dest, cmd, args):
+        """ Send a message, with noise or a bad checksum if requested."""
+        if random.random() < self.context.simBadChecksumRate:
+            msg = dest+cmd+args
+            checksum = byteChr[(ord(self.encoder.checksum(DLE+STX+msg)) + 1) & 0xff]
+            frame = DLE+STX+(msg+checksum).replace(DLE, DLE+NUL)+DLE+ETX
+        else:
+            frame = self.encoder.encode((dest, cmd, args))
+        if random.random() < self.context.simNoiseRate:
+            frame = "".join(byteChr[random.randrange(256)] for i in range(random.randrange(1, 8))) + frame
+        os.write(self.masterFd, frame)
+
+    def readAck(self):
+        """ Wait for an ack to the controller and return its arguments, or None."""
+        deadline = time.time() + self.context.simAckTimeout
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return None
+            (readable, writable, errors) = select.select([self.masterFd], [], [], timeout)
+            if not readable:
+                return None
+            for frame in self.framer.feed(os.read(self.masterFd, readSize)):
+                if (frame[0] == masterAddr) and (frame[1] == self.cmdAck) and \
+                        (self.encoder.checksum(DLE+STX+frame[:-1]) == frame[-1]):
+                    return frame[2:-1]
+
+    def close(self):
+        if self.deviceName != self.slaveName:
+            os.remove(self.deviceName)
+        os.close(self.slaveFd)
+        os.close(self.masterFd)
+
+class SimDevice(object):
+    """ State of a simulated panel address."""
+    def __init__(self, theAddr, theRate):
+        self.addr = theAddr
+        self.interval = 1.0 / theRate
+        self.nextPoll = 0.0
+        self.probed = False
+        self.count = 0
+        self.pending = []       # messages to send before resuming the rotation, a status has args None
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import time
+import Queue
+import socket
+import threading
+
+from gatewayport import isSocketName, socketAddress
+
+writeTimeout = 0.5          # time the writer waits for events before checking if the program is running
+reconnectInterval = 5.0     # seconds between attempts to reconnect a socket output
+
+# device families by base address, each has 4 addresses
+deviceTypes = {0x00: "master",
+               0x08: "allButton",
+               0x20: "spaSide",
+               0x40: "oneTouch",
+               0x48: "rsAdapter",
+               0x50: "chlorinator",
+               0x60: "pda"}
+
+# names of the commands that are common to the devices
+cmdNames = {0x00: "probe",
+            0x01: "ack",
+            0x02: "status",
+            0x03: "msg",
+            0x04: "longMsg"}
+
+class Sniffer(object):
+    """ Passive bus decoder.
+
+    Every message on the bus that passes the filters is recorded as an event with
+    the time its chunk was read, and written by a background thread as a line of
+    JSON to a file, or to a socket if the output is tcp://host:port or
+    unix:path.  A message to the master is an ack or response from the device
+    that was addressed last, which is reported as its source and is used for the
+    address filter.
+
+    The address and command filters are tables indexed by byte value, so a
+    message that is filtered out costs two lookups.  Events are dropped and
+    counted if the writer falls behind.
+    """
+    def __init__(self, theName, theContext, theOutput, theAddrs="", theCmds=""):
+        self.name = theName
+        self.context = theContext
+        self.output = theOutput
+        self.addrTable = filterTable(theAddrs)
+        self.cmdTable = filterTable(theCmds)
+        self.queue = Queue.Queue(self.context.sniffQueueSize)
+        self.drops = 0              # total number of events dropped
+        self.lastAddr = 0           # address of the last message that wasn't to the master
+        self.outFile = None
+        self.outSocket = None
+        self.connectTime = 0.0
+
+    def start(self):
+        writeThread = threading.Thread(target=self.writeEvents, name=self.name)
+        writeThread.start()
+
+    def add(self, theTime, frame, valid):
+        """ Record a message body read at a time if it passes the filters."""
+        dest = ord(frame[0])
+        if dest == 0:
+            addr = self.lastAddr
+        else:
+            addr = dest
+            self.lastAddr = dest
+        if self.addrTable[addr] and self.cmdTable[ord(frame[1])]:
+            try:
+                self.queue.put_nowait((theTime, addr, frame, valid))
+            except Queue.Full:
+                self.drops += 1
+
+    def writeEvents(self):
+        if self.context.debug: self.context.logDebug(self.name, "sniffing to", self.output)
+        while self.context.running or not self.queue.empty():
+            try:
+                batch = [self.queue.get(True, writeTimeout)]
+            except Queue.Empty:
+                continue
+            # take everything else that is waiting
+            try:
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            self.write("".join(formatEvent(event) for event in batch))
+        self.close()
+        if self.context.debug: self.context.logDebug(self.name, "terminating sniffer", "drops", self.drops)
+
+    def write(self, data):
+        if isSocketName(self.output):
+            if self.outSocket is None:
+                if time.time() < self.connectTime + reconnectInterval:
+                    return
+                self.connect()
+                if self.outSocket is None:
+                    return
+            try:
+                self.outSocket.sendall(data)
+            except socket.error as ex:
+                self.context.logWarning(self.name, "error writing to", self.output, ex)
+                self.outSocket.close()
+                self.outSocket = None
+        else:
+            if self.outFile is None:
+                self.outFile = open(self.output, "a")
+            self.outFile.write(data)
+            self.outFile.flush()
+
+    def connect(self):
+        self.connectTime = time.time()
+        (family, address) = socketAddress(self.output)
+        try:
+            self.outSocket = socket.socket(family, socket.SOCK_STREAM)
+            self.outSocket.connect(address)
+        except socket.error as ex:
+            self.outSocket.close()
+            self.context.logWarning(self.name, "can't connect to", self.output, ex)
+            self.outSocket = None
+
+    def close(self):
+        if self.outFile: self.outFile.close()
+        if self.outSocket: self.outSocket.close()
+
+def filterTable(addrs):
+    """ Return a table indexed by byte value that is True for the bytes in a string,
+    or for all of them if the string is empty."""
+    if not addrs:
+        return [True] * 256
+    table = [False] * 256
+    for addr in addrs:
+        table[ord(addr)] = True
+    return table
+
+def formatEvent((eventTime, addr, frame, valid)):
+    """ Return a message event as a line of JSON."""
+    dest = ord(frame[0])
+    cmd = ord(frame[1])
+    return '{"time": %.6f, "dest": "%02x", "addr": "%02x", "device": "%s", "cmd": "%02x", "name": "%s", "args": "%s", "valid": %s}\n' % \
+           (eventTime, dest, addr, deviceTypes.get(addr & 0xfc, "unknown"), cmd, cmdNames.get(cmd, "unknown"),
+            frame[2:-1].encode("hex"), "true" if valid else "false")
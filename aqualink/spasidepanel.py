@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from pool import *
+from panel import *
+from allbuttonpanel import *
+
+########################################################################################################
+# Spa Side panel
+########################################################################################################
+
+class SpaSidePanel(LedPanel):
+    """
+    Aqualink Spa Side Control Panel
+
+    The spa side panel has 4 buttons and 4 LEDs and no display.  It is polled like the
+    All Button panel and receives the same LED status, and the controller accepts the
+    All Button codes of its buttons.
+
+    The buttons are: spa, spa heater, jets (aux2), and spa light (aux5).
+
+    The device address is 0x20-0x23.
+
+    Probe
+        command: 0x00
+        args: none
+
+    Ack
+        command: 0x01
+        args: 2 bytes
+            byte 0: 0x00
+            byte 1: button number that was pressed
+
+    Status
+        command: 0x02
+        args: 5 bytes
+            bytes 0-4:  LED status
+
+    Messages and long messages are ignored.
+    """
+    # constructor
+    def __init__(self, theName, theContext, thePool):
+        LedPanel.__init__(self, theName, theContext, thePool)
+
+        # addressing
+        self.baseAddr = 0x20
+        self.maxDevices = 4
+
+        # commands
+        self.cmdLongMsg = Command("longMsg", 0x04, 17)
+
+        # buttons
+        self.btnSpa          = Button("spa", 0x01)
+        self.btnSpaHtr       = Button("spahtr", 0x17)
+        self.btnJets         = Button("jets", 0x0a)
+        self.btnLight        = Button("light", 0x0b)
+
+        # command parsing
+        self.cmdTable.update({self.cmdLongMsg.code: Panel.handleMsg})
+
+        # equipment controlled by the buttons and its status masks
+        self.setEquipment([PanelEquip(self.pool.aux2, self.btnJets, 0xc000000000),
+                           PanelEquip(self.pool.aux5, self.btnLight, 0x00c0000000),
+                           PanelEquip(self.pool.spa, self.btnSpa, 0x000c000000),
+                           PanelEquip(self.pool.heater, self.btnSpaHtr, 0x000000000f)])
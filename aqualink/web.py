@@ -2,14 +2,22 @@
 # coding=utf-8
 
 import os
+import cgi
+import time
+import json
+import threading
+import Queue
 import cherrypy
 from jinja2 import Environment, FileSystemLoader
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
+# the templates are compiled once for all the pools
+templateEnv = Environment(loader=FileSystemLoader(os.path.join(BASE_DIR, '../templates')))
+
 class WebUI(object):
     # constructor
-    def __init__(self, theName, theContext, thePool):
+    def __init__(self, theName, theContext, thePool=None):
         self.name = theName
         self.context = theContext
         self.pool = thePool
@@ -17,8 +25,10 @@ class WebUI(object):
         globalConfig = {
             'server.socket_port': 8080,
             'server.socket_host': "0.0.0.0",
+            # each open event stream holds a thread, the others serve requests
+            'server.thread_pool': self.context.webThreads + self.context.eventStreams,
             }
-        appConfig = {
+        self.appConfig = {
             '/css': {
                 'tools.staticdir.on': True,
                 'tools.staticdir.root': os.path.join(BASE_DIR, "../static"),
@@ -30,19 +40,45 @@ class WebUI(object):
             },
         }    
         cherrypy.config.update(globalConfig)
-        root = WebRoot(self.name, self.context, self.pool)
-        cherrypy.tree.mount(root, "/", appConfig)
+        # event streams open at once for all the pools
+        self.streamSlots = threading.BoundedSemaphore(self.context.eventStreams)
+        if self.pool:
+            self.mount("", self.pool)
+
+    def mount(self, poolId, thePool):
+        # serve a pool at /poolId, or at / if poolId is empty
+        root = WebRoot(self.name, thePool.context, thePool, self.streamSlots)
+        cherrypy.tree.mount(root, "/"+poolId, self.appConfig)
+
+    def mountPools(self, thePools):
+        # serve each of a dictionary of pools at /id, and a list of them at /
+        for (poolId, pool) in thePools.items():
+            self.mount(poolId, pool)
+        cherrypy.tree.mount(PoolIndex(thePools), "/", self.appConfig)
 
     def block(self):
         cherrypy.engine.start()
         cherrypy.engine.block()
 
 class WebRoot(object):
-    def __init__(self, theName, theContext, thePool):
+    def __init__(self, theName, theContext, thePool, theStreamSlots):
         self.name = theName
         self.context = theContext
         self.pool = thePool
-        self.env = Environment(loader=FileSystemLoader(os.path.join(BASE_DIR, '../templates')))
+        self.streamSlots = theStreamSlots
+        self.template = templateEnv.get_template("index.html")
+        self.broadcaster = Broadcaster(self.name+" Events", self.context, self.pool)
+
+        # serialized state bodies for the current version, keyed by the requested fields
+        self.stateLock = threading.Lock()
+        self.stateSnapshot = None
+        self.stateVersion = -1
+        self.stateBodies = {}
+        self.etagPrefix = "%x" % int(time.time())   # distinguishes versions from previous runs
+
+        # rendered page and its version
+        self.renderLock = threading.Lock()
+        self.page = (-1, "")
 
         # mode dispatch table
         self.modeTable = {"Lights": WebRoot.lightsMode,
@@ -58,11 +94,147 @@ class WebRoot(object):
     def pool(self, mode=None):
         if mode != None:
             self.modeTable[mode](self)
-        t = self.env.get_template("index.html")
-        return t.render(pool=self.pool)
+        return self.renderPage()
 
     index = pool
 
+    def renderPage(self):
+        # return the page for the current version, rendering it only once per version
+        (version, page) = self.page
+        if version == self.pool.snapshot.version:
+            return page
+        with self.renderLock:
+            # requests waiting here get the page rendered by the first one
+            (version, page) = self.page
+            snapshot = self.pool.snapshot
+            if version != snapshot.version:
+                version = snapshot.version
+                if self.context.debugWeb: self.context.logDebug(self.name, "rendering page", version)
+                page = self.template.render(pool=snapshot)
+                self.page = (version, page)
+            return page
+
+    @cherrypy.expose
+    def state(self, fields=None):
+        """ Return the state values as JSON.
+
+        fields is an optional comma separated list of the values to return.  The
+        ETag is the state version, so a client that already has it gets a 304."""
+        cherrypy.response.headers["Cache-Control"] = "no-cache"
+        etag = self.etag(self.pool.snapshot.version)
+        if etag in cherrypy.request.headers.get("If-None-Match", "").split(", "):
+            cherrypy.response.headers["ETag"] = etag
+            cherrypy.response.status = 304
+            return ""
+        if fields is None:
+            names = tuple(self.pool.valueNames)
+        else:
+            names = tuple(fields.split(","))
+            for name in names:
+                if name not in self.pool.valueNames:
+                    raise cherrypy.HTTPError(400, "unknown field "+name)
+        (version, body) = self.stateBody(self.pool.snapshot, names)
+        cherrypy.response.headers["ETag"] = self.etag(version)
+        cherrypy.response.headers["Content-Type"] = "application/json"
+        return body
+
+    def etag(self, version):
+        return '"%s-%d"' % (self.etagPrefix, version)
+
+    def stateBody(self, snapshot, names):
+        # return the newest version and its serialized values, building them once per version
+        with self.stateLock:
+            if snapshot.version > self.stateVersion:
+                self.stateSnapshot = snapshot
+                self.stateVersion = snapshot.version
+                self.stateBodies = {}
+            try:
+                return (self.stateVersion, self.stateBodies[names])
+            except KeyError:
+                if self.context.debugWeb: self.context.logDebug(self.name, "serializing state", self.stateVersion)
+                body = json.dumps({"version": self.stateVersion,
+                                   "values": self.pool.stateDict(self.stateSnapshot, names)}, encoding="latin-1")
+                self.stateBodies[names] = body
+                return (self.stateVersion, body)
+
+    @cherrypy.expose
+    def history(self, name, start=None, end=None, points=None):
+        """ Return the history of a state value as JSON.
+
+        start and end are Unix times, and default to the last day when points is
+        given.  Without points the samples are returned, with it they are reduced to
+        the minimum, maximum and mean of at most that many intervals."""
+        if self.pool.history is None:
+            raise cherrypy.NotFound()
+        if name not in self.pool.history.metrics:
+            raise cherrypy.HTTPError(400, "unknown history "+name)
+        try:
+            start = None if start is None else float(start)
+            end = None if end is None else float(end)
+            points = None if points is None else int(points)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "invalid history range")
+        cherrypy.response.headers["Content-Type"] = "application/json"
+        if points is None:
+            (times, values) = self.pool.history.query(name, start, end)
+            return json.dumps({"name": name, "time": times.tolist(), "value": values.tolist()})
+        if end is None:
+            end = time.time()
+        if start is None:
+            start = end - 86400
+        if (points < 1) or (start >= end):
+            raise cherrypy.HTTPError(400, "invalid history range")
+        (times, minimum, maximum, mean) = self.pool.history.downsample(name, start, end, points)
+        return json.dumps({"name": name, "time": times.tolist(), "min": minimum.tolist(),
+                           "max": maximum.tolist(), "mean": mean.tolist()})
+
+    @cherrypy.expose
+    def metrics(self):
+        """ Return the metrics in the Prometheus text format."""
+        cherrypy.response.headers["Content-Type"] = "text/plain; version=0.0.4"
+        return self.pool.metrics.format()
+
+    @cherrypy.expose
+    def profile(self, seconds=None):
+        """ Return the message handler statistics as text.
+
+        If seconds is given, the read thread is also profiled for that long."""
+        if seconds is not None:
+            try:
+                self.pool.profiler.requestCapture(float(seconds))
+            except ValueError:
+                raise cherrypy.HTTPError(400, "invalid profile time")
+        cherrypy.response.headers["Content-Type"] = "text/plain"
+        return self.pool.profiler.format()
+
+    @cherrypy.expose
+    def events(self):
+        """ Stream state changes as server-sent events.
+
+        The first event has all the state values, after that each event has the
+        values that changed.  If eventStreams are already open the request gets a
+        503, and the page polls /state instead."""
+        if not self.streamSlots.acquire(False):
+            if self.context.debugWeb: self.context.logDebug(self.name, "too many event streams")
+            raise cherrypy.HTTPError(503, "too many event streams")
+        cherrypy.response.headers["Content-Type"] = "text/event-stream"
+        cherrypy.response.headers["Cache-Control"] = "no-cache"
+        subscriber = self.broadcaster.subscribe()
+        def stream():
+            try:
+                while self.context.running:
+                    try:
+                        values = subscriber.get(True, self.context.eventKeepalive)
+                    except Queue.Empty:
+                        yield ": keepalive\n\n"
+                        continue
+                    yield "data: "+json.dumps(values, encoding="latin-1")+"\n\n"
+            finally:
+                self.broadcaster.unsubscribe(subscriber)
+                self.streamSlots.release()
+        return stream()
+    events._cp_config = {"response.stream": True}
+
     def lightsMode(self):
         self.pool.lightsMode.changeState()
 
@@ -71,4 +243,62 @@ class WebRoot(object):
 
     def cleanMode(self):
         self.pool.cleanMode.changeState()
-        
+
+class PoolIndex(object):
+    def __init__(self, thePools):
+        self.pools = thePools
+
+    @cherrypy.expose
+    def index(self):
+        links = "".join("<li><a href='%s/'>%s</a> %s</li>" % (poolId, poolId, cgi.escape(pool.snapshot.title))
+                        for (poolId, pool) in self.pools.items())
+        return "<html><head><title>Pools</title></head><body><ul>"+links+"</ul></body></html>"
+
+class Broadcaster(object):
+    """ Send state changes to the subscribed event streams.
+
+    Each subscriber has a bounded queue of changed values.  A subscriber that falls
+    behind is cleared and sent all the state values instead.  Nothing is done for
+    a change when there are no subscribers."""
+    def __init__(self, theName, theContext, thePool):
+        self.name = theName
+        self.context = theContext
+        self.pool = thePool
+        self.subscribers = []
+        self.subscriberLock = threading.Lock()
+        self.pool.addListener(self.notify)
+
+    def subscribe(self):
+        subscriber = Queue.Queue(self.context.eventQueueSize)
+        with self.subscriberLock:
+            # changes made after this snapshot are sent after it
+            subscriber.put(self.pool.stateDict(self.pool.snapshot))
+            self.subscribers.append(subscriber)
+        if self.context.debugWeb: self.context.logDebug(self.name, "subscribed", len(self.subscribers))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.subscriberLock:
+            self.subscribers.remove(subscriber)
+        if self.context.debugWeb: self.context.logDebug(self.name, "unsubscribed", len(self.subscribers))
+
+    def notify(self, snapshot, names):
+        # called from the thread that changed the state
+        if not self.subscribers:
+            return
+        values = self.pool.stateDict(snapshot, [name for name in names if name in self.pool.valueNames])
+        if not values:
+            return
+        with self.subscriberLock:
+            for subscriber in self.subscribers:
+                try:
+                    subscriber.put_nowait(values)
+                except Queue.Full:
+                    self.resync(subscriber, snapshot)
+
+    def resync(self, subscriber, snapshot):
+        # replace the queued changes with all the state values
+        if self.context.debugWeb: self.context.logDebug(self.name, "resynchronizing subscriber")
+        with subscriber.mutex:
+            subscriber.queue.clear()
+        subscriber.put_nowait(self.pool.stateDict(snapshot))
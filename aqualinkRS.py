@@ -12,5 +12,6 @@ from BTUtils import *
 if __name__ == "__main__":
     app = BTApp("config.py", "aqualink.log", {})
     thePool = Pool("Pool", app)
+    thePool.start()
     serialUI = SerialUI("SerialUI", app, thePool)
 
@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from aqualink.poolset import *
+from aqualink.web import *
+from BTUtils import *
+
+########################################################################################################
+# main routine
+########################################################################################################
+
+if __name__ == "__main__":
+    app = BTApp("config.py", "aqualink.log", {})
+    poolSet = PoolSet("Pools", app)
+    poolSet.start()
+    webUI = WebUI("WebUI", app)
+    webUI.mountPools(poolSet.pools)
+    try:
+        webUI.block()
+    finally:
+        app.running = False
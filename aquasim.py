@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import time
+
+from aqualink.simulator import *
+from BTUtils import *
+
+########################################################################################################
+# main routine
+########################################################################################################
+
+if __name__ == "__main__":
+    app = BTApp("config.py", "aquasim.log", {})
+    sim = Simulator("Simulator", app)
+    print "Aqualink controller simulator on", sim.deviceName
+    sim.start()
+    try:
+        while app.running:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        app.running = False
+    sim.close()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+
+from benchutil import *
+
+########################################################################################################
+# RS485 framing and encoding
+########################################################################################################
+
+def benchReadMsg(workDir, quick):
+    """ Messages per second returned by Interface.readMsg from a capture replayed at full speed."""
+    pool = makePool(workDir)
+    captureFileName = os.path.join(workDir, "bus.cap")
+    nMsgs = writeCapture(captureFileName, busMsgs, 200 if quick else 2000)
+    best = None
+    for i in range(3):
+        pool.interface.port = ReplayPort("Replay", pool.context, captureFileName, 0)
+        pool.context.running = True
+        start = monotonic()
+        n = 0
+        while pool.interface.readMsg() is not None:
+            n += 1
+        elapsed = monotonic() - start
+        if (best is None) or (elapsed < best):
+            best = elapsed
+    pool.context.running = True
+    return {"readMsg": rate(nMsgs / best, "msgs/s")}
+
+def benchChecksum(workDir, quick):
+    """ Checksums per second for a status message and a text message."""
+    pool = makePool(workDir)
+    status = DLE+STX+'\x09\x02\x00\x30\x00\x00\x00'
+    text = DLE+STX+'\x09\x03\x00'+'AIR TEMP 72\xdfF'.ljust(16)
+    number = 2000 if quick else 20000
+    return {"checksum.status": rate(1 / measure(lambda: pool.interface.checksum(status), number), "checksums/s"),
+            "checksum.msg": rate(1 / measure(lambda: pool.interface.checksum(text), number), "checksums/s")}
+
+def benchSendMsg(workDir, quick):
+    """ Messages per second encoded and written by Interface.sendMsg and ack messages sent per second."""
+    pool = makePool(workDir)
+    msg = ('\x00', '\x01', '\x00\x10')
+    panel = pool.panel
+    slot = panel.slots[0]
+    number = 2000 if quick else 20000
+    def sendAck():
+        slot.button = panel.btnAux6
+        pool.interface.sendFrame(slot.getAck()[1])
+    return {"sendMsg": rate(1 / measure(lambda: pool.interface.sendMsg(msg), number), "msgs/s"),
+            "sendAck": rate(1 / measure(sendAck, number), "msgs/s")}
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from benchutil import *
+
+########################################################################################################
+# panel message handling
+########################################################################################################
+
+# status words that turn one piece of equipment on or off at a time
+statusArgs = ['\x00\x00\x00\x00\x00',
+              '\x00\x30\x00\x00\x00',
+              '\x00\x3c\x00\x00\x00',
+              '\x00\x3c\x03\x00\x01',
+              '\x00\x0c\x03\x00\x01',
+              '\x00\x0c\x00\x00\x01',
+              '\x00\x00\x00\x00\x00']
+
+msgArgs = ['\x00'+'AIR TEMP 72\xdfF'.ljust(16),
+           '\x00'+'POOL TEMP 80\xdfF'.ljust(16),
+           '\x00'+'SPA TEMP 100\xdfF'.ljust(16),
+           '\x00'+'10/18/26 SUN'.ljust(16),
+           '\x00'+'09:03 AM'.ljust(16),
+           '\x00'+'SIMULATED POOL'.ljust(16)]
+
+def cycle(items):
+    """ Return a function that returns the items in rotation."""
+    state = {"i": 0}
+    def nextItem():
+        i = state["i"]
+        state["i"] = (i + 1) % len(items)
+        return items[i]
+    return nextItem
+
+def benchParseMsg(workDir, quick):
+    """ Messages per second dispatched by Panel.parseMsg."""
+    pool = makePool(workDir)
+    panel = pool.panel
+    panel.firstMsg = False
+    nextMsg = cycle([('\x00', ''), ('\x02', '\x00\x00\x00\x00\x00')] +
+                    [('\x03', args) for args in msgArgs])
+    def parse():
+        (cmd, args) = nextMsg()
+        panel.parseMsg(cmd, args)
+    return {"parseMsg": rate(1 / measure(parse, 2000 if quick else 20000), "msgs/s")}
+
+def benchHandleStatus(workDir, quick):
+    """ Status messages per second decoded by AllButtonPanel.handleStatus, when every one changes."""
+    pool = makePool(workDir)
+    panel = pool.panel
+    nextStatus = cycle(statusArgs)
+    return {"handleStatus": rate(1 / measure(lambda: panel.handleStatus(nextStatus()), 500 if quick else 5000), "msgs/s")}
+
+def benchHandleMessage(workDir, quick):
+    """ Text messages per second decoded by AllButtonPanel.handleMessage."""
+    pool = makePool(workDir)
+    panel = pool.panel
+    panel.firstMsg = False
+    nextMsg = cycle(msgArgs)
+    return {"handleMessage": rate(1 / measure(lambda: panel.handleMessage(panel.cmdMsg, nextMsg()), 2000 if quick else 20000), "msgs/s")}
+
+def benchDecodeBatch(workDir, quick):
+    """ Status values per second decoded by StatusDecoder.decodeBatch."""
+    pool = makePool(workDir)
+    statusList = [pool.panel.statusDecoder.unpack(args) for args in statusArgs] * 100
+    number = 10 if quick else 100
+    return {"decodeBatch": rate(len(statusList) / measure(lambda: pool.panel.statusDecoder.decodeBatch(statusList), number), "status/s")}
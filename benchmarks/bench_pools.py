@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+import resource
+
+from benchutil import *
+from aqualink.poolset import *
+
+########################################################################################################
+# cost of running several pools in one process
+########################################################################################################
+
+def residentSize():
+    """ Return the resident memory of the process in KB."""
+    with open("/proc/self/statm") as statmFile:
+        return int(statmFile.read().split()[1]) * resource.getpagesize() / 1024.0
+
+def makePoolSet(workDir, nPools):
+    """ Return a PoolSet of pools that share an event loop and each read an empty capture file."""
+    captureFileName = os.path.join(workDir, "empty.cap")
+    writeCapture(captureFileName, [], 0)
+    pools = {}
+    for i in range(nPools):
+        poolId = "pool%d" % i
+        configFileName = os.path.join(workDir, poolId+".py")
+        with open(configFileName, "w") as configFile:
+            configFile.write('stateFileName = "%s"\n' % os.path.join(workDir, poolId+".dat"))
+            configFile.write('historyFileName = "%s"\n' % os.path.join(workDir, poolId+"_history.dat"))
+        pools[poolId] = configFileName
+    context = makeContext(workDir, {"replayFile": captureFileName, "replaySpeed": 0,
+                                    "eventLoop": True, "pools": pools})
+    return PoolSet("Pools", context)
+
+def benchPoolCost(workDir, quick):
+    """ Time to create each pool of a PoolSet and the resident memory it adds."""
+    nPools = 10 if quick else 50
+    # the first pool set loads the modules and templates
+    makePoolSet(workDir, 1)
+    before = residentSize()
+    start = monotonic()
+    poolSet = makePoolSet(workDir, nPools)
+    elapsed = monotonic() - start
+    after = residentSize()
+    return {"pools.createTime": latency(elapsed / nPools * 1000),
+            "pools.memory": latency((after - before) / nPools, "KB")}
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import time
+
+from benchutil import *
+from aqualink.simulator import *
+
+########################################################################################################
+# action round trip against the controller simulator
+########################################################################################################
+
+simRate = 20.0          # polls per second of the simulated controller
+
+def benchChangeState(workDir, quick):
+    """ Time from Equipment.changeState to the matching status LED change, against the simulator."""
+    context = makeContext(workDir, {"simPanels": {'\x09': simRate},
+                                    "simNoiseRate": 0.0,
+                                    "simBadChecksumRate": 0.0})
+    sim = Simulator("Simulator", context)
+    context.RS485Device = sim.deviceName
+    sim.start()
+    pool = Pool("Pool", context)
+    pool.start()
+    try:
+        # wait for the panel to be probed and the first status
+        pool.panel.statusEvent.clear()
+        pool.panel.statusEvent.wait(5)
+        times = []
+        for i in range(4 if quick else 10):
+            newState = Equipment.stateOff if pool.pump.state else Equipment.stateOn
+            start = monotonic()
+            future = pool.pump.changeState(newState)
+            while (pool.pump.state != newState) and not future.done():
+                time.sleep(0.001)
+            times.append((monotonic() - start) * 1000)
+            # let the action finish before starting another one
+            future.wait()
+    finally:
+        context.running = False
+        time.sleep(1)
+        sim.close()
+    times.sort()
+    return {"changeState.mean": latency(sum(times) / len(times)),
+            "changeState.median": latency(times[len(times) // 2]),
+            "changeState.max": latency(times[-1])}
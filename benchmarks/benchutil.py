@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from BTUtils import *
+from aqualink.pool import *
+from aqualink.capture import *
+
+########################################################################################################
+# benchmark helpers
+########################################################################################################
+
+# traffic on a bus with an All Button panel at 0x09 and another panel at 0x0a
+busMsgs = [('\x09', '\x00', ''),
+           ('\x00', '\x01', '\x00\x00'),
+           ('\x09', '\x02', '\x00\x30\x00\x00\x00'),
+           ('\x00', '\x01', '\x00\x00'),
+           ('\x0a', '\x00', ''),
+           ('\x00', '\x01', '\x00\x00'),
+           ('\x09', '\x03', '\x00'+'AIR TEMP 72\xdfF'.ljust(16)),
+           ('\x00', '\x01', '\x00\x00'),
+           ('\x0a', '\x02', '\x00\x30\x00\x00\x00'),
+           ('\x00', '\x01', '\x00\x00'),
+           ('\x09', '\x03', '\x00'+'POOL TEMP 80\xdfF'.ljust(16)),
+           ('\x00', '\x01', '\x00\x10'),
+           ('\x09', '\x04', '\x00'+'10 ON'.ljust(16))]
+
+def makeContext(workDir, config={}):
+    """ Return an application context with debugging turned off."""
+    app = BTApp(os.path.join(ROOT, "config.py"), os.path.join(workDir, "bench.log"), {})
+    app.setConfig({"logFileName": os.path.join(workDir, "bench.log"),
+                   "debug": False,
+                   "debugData": False,
+                   "debugRaw": False,
+                   "debugAck": False,
+                   "debugStatus": False,
+                   "debugAction": False,
+                   "debugMsg": False,
+                   "captureFile": "",
+                   "replayFile": "",
+                   "simDevice": ""})
+    app.setConfig(config)
+    return app
+
+def writeCapture(fileName, msgs, nTimes, chunkSize=64):
+    """ Write a capture file containing a list of messages repeated n times.
+    The data is split into chunks like a serial port would return it."""
+    encoder = FrameEncoder()
+    data = "".join(encoder.encode(msg) for msg in msgs) * nTimes
+    capture = CaptureFile("Capture", NullContext(), fileName)
+    for i in range(0, len(data), chunkSize):
+        capture.write(data[i:i+chunkSize])
+    capture.close()
+    return len(msgs) * nTimes
+
+def makePool(workDir, config={}):
+    """ Return a Pool that reads an empty capture file and has not been started."""
+    captureFileName = os.path.join(workDir, "empty.cap")
+    writeCapture(captureFileName, [], 0)
+    context = makeContext(workDir, dict({"replayFile": captureFileName, "replaySpeed": 0}, **config))
+    return Pool("Pool", context)
+
+def measure(func, number, repeat=3):
+    """ Call a function number times, repeat times, and return the best time per call."""
+    best = None
+    for i in range(repeat):
+        start = monotonic()
+        for j in xrange(number):
+            func()
+        elapsed = (monotonic() - start) / number
+        if (best is None) or (elapsed < best):
+            best = elapsed
+    return best
+
+def rate(value, unit):
+    """ A result where a higher value is better."""
+    return {"value": value, "unit": unit, "better": "higher"}
+
+def latency(value, unit="ms"):
+    """ A result where a lower value is better."""
+    return {"value": value, "unit": unit, "better": "lower"}
+
+class NullContext(object):
+    """ Context that discards log messages."""
+    running = True
+    def log(self, *args):
+        pass
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import importlib
+
+from benchutil import *
+
+########################################################################################################
+# benchmark runner
+########################################################################################################
+
+BENCH_DIR = os.path.abspath(os.path.dirname(__file__))
+
+def findBenchmarks(pattern):
+    """ Return the benchmark functions in the bench_*.py modules whose names contain the pattern."""
+    benchmarks = []
+    for fileName in sorted(glob.glob(os.path.join(BENCH_DIR, "bench_*.py"))):
+        module = importlib.import_module(os.path.splitext(os.path.basename(fileName))[0])
+        for name in sorted(dir(module)):
+            if name.startswith("bench") and callable(getattr(module, name)):
+                fullName = module.__name__+"."+name
+                if pattern in fullName:
+                    benchmarks.append((fullName, getattr(module, name)))
+    return benchmarks
+
+def runBenchmarks(benchmarks, quick):
+    """ Run the benchmarks, each in its own working directory, and return the results."""
+    results = {}
+    cwd = os.getcwd()
+    for (fullName, bench) in benchmarks:
+        workDir = tempfile.mkdtemp(prefix="aquabench")
+        os.chdir(workDir)
+        try:
+            sys.stdout.write("%-40s" % fullName)
+            sys.stdout.flush()
+            benchResults = bench(workDir, quick)
+            print
+            for name in sorted(benchResults.keys()):
+                result = benchResults[name]
+                print "    %-36s %14.3f %s" % (name, result["value"], result["unit"])
+            results.update(benchResults)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workDir, ignore_errors=True)
+    return results
+
+def compareResults(results, baseline, threshold):
+    """ Print the change of each result from a baseline and return the number of regressions."""
+    regressions = 0
+    print
+    print "%-40s %14s %14s %8s" % ("compared to baseline", "baseline", "current", "change")
+    for name in sorted(results.keys()):
+        if name not in baseline:
+            continue
+        old = baseline[name]["value"]
+        new = results[name]["value"]
+        change = (new - old) / old * 100 if old else 0.0
+        worse = -change if results[name]["better"] == "higher" else change
+        flag = ""
+        if worse > threshold:
+            flag = "REGRESSION"
+            regressions += 1
+        print "%-40s %14.3f %14.3f %+7.1f%% %s" % (name, old, new, change, flag)
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the pyaqualink benchmarks.")
+    parser.add_argument("-k", dest="pattern", default="", help="only run benchmarks whose names contain this")
+    parser.add_argument("-o", dest="output", default=os.path.join(BENCH_DIR, "results", time.strftime("%Y%m%d-%H%M%S")+".json"),
+                        help="file the results are saved to")
+    parser.add_argument("-c", dest="compare", default="", help="results file to compare with")
+    parser.add_argument("-t", dest="threshold", type=float, default=15.0, help="percent change reported as a regression")
+    parser.add_argument("--quick", action="store_true", help="run fewer iterations")
+    args = parser.parse_args()
+
+    results = runBenchmarks(findBenchmarks(args.pattern), args.quick)
+
+    outputDir = os.path.dirname(os.path.abspath(args.output))
+    if not os.path.isdir(outputDir):
+        os.makedirs(outputDir)
+    with open(args.output, "w") as outputFile:
+        json.dump({"time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                   "python": platform.python_version(),
+                   "platform": platform.platform(),
+                   "quick": args.quick,
+                   "results": results}, outputFile, indent=2, sort_keys=True)
+    print
+    print "results saved to", args.output
+
+    if args.compare != "":
+        with open(args.compare) as baselineFile:
+            baseline = json.load(baselineFile)["results"]
+        if compareResults(results, baseline, args.threshold):
+            sys.exit(1)
@@ -2,6 +2,11 @@
 # configuration
 ##################################################################
 logFileName = "aqualink.log"
+logLevel = "DEBUG"                  # lowest level of messages written: DEBUG, INFO, WARNING or ERROR
+logCategories = {}                  # lowest level for specific categories, e.g. {"Read": "WARNING"}
+logQueueSize = 10000                # messages waiting to be written before new ones are dropped
+logMaxBytes = 1000000               # size the log file is rotated at, 0 to never rotate
+logBackups = 3                      # number of rotated log files kept
 
 debug = True                        # general debug messages
 debugData = False                   # show parsed aqualink messages
@@ -13,9 +18,47 @@ debugMsg = False                    # show text messages received from controlle
 debugHttp = False
 debugWeb = False
 
-RS485Device = "/dev/ttyUSB0"        # RS485 serial device to be used
+RS485Device = "/dev/ttyUSB0"        # RS485 serial device to be used, or tcp://host:port or unix:path of a gateway
 RS232Device = "/dev/stdin"          # RS232 serial device to be used
 allButtonPanelAddr = '\x09'         # address of All Button control panel
+allButtonExtraAddrs = ""            # more All Button addresses to send equipment buttons from, e.g. '\x0a\x0b'
+spaSidePanelAddr = ""               # address of Spa Side control panel, "" if it isn't emulated
 httpPort = 80                       # web server port
+webThreads = 30                     # web server threads for requests other than event streams
+eventStreams = 20                   # event streams open at once, each holds a web thread, more get a 503
+eventKeepalive = 15.0               # seconds between keepalives on an idle event stream
+eventQueueSize = 100                # changes queued for an event stream before it is resynchronized
 monitorMode = False                 # true if monitoring another panel
+clockDriftThreshold = 120           # seconds the controller clock may be off before it is set
+clockRepeat = False                 # true if the controller repeats arrow buttons sent in consecutive acks
+clockPressTime = 1.0                # predicted seconds for a button press that waits for the controller
+clockRepeatTime = 0.2               # predicted seconds for a repeated arrow button press
+actionTimeout = 10.0                # seconds an action waits for the controller before it fails
+eventLoop = False                   # handle messages, actions and RS232 commands in one event loop thread
+pools = {}                          # pool id: configuration file of each pool run by aquapools.py, e.g. {"north": "north.py"}
+fastAck = False                     # send acks from the read thread and parse messages in another thread
+ackDeadline = 0.01                  # seconds after a message is read that its ack is counted as late
+stateFileName = "pool.dat"          # file the pool state is written to
+stateWriteInterval = 10.0           # seconds between writes of the pool state file
+historyFileName = "history.dat"     # file the state history is appended to, "" to disable it
+historySize = 20000                 # samples of each value kept in memory
+metricsEnabled = True               # count messages and time acks and actions for the metrics page
+profileInterval = 100               # messages between timed calls of the message handlers, 0 to not profile
+profileWindow = 10.0                # seconds the read thread is profiled for on request
+profileFileName = "read.prof"       # file the read thread profile is written to
+captureFile = ""                    # file to capture raw RS485 data to
+replayFile = ""                     # capture file to read instead of the RS485 device
+replaySpeed = 1.0                   # replay speed multiplier, 0 for as fast as possible
+sniffOutput = ""                    # file, tcp://host:port or unix:path every bus message is recorded to, "" for none
+sniffAddrs = ""                     # device addresses recorded by the sniffer, e.g. '\x08\x50', "" for all
+sniffCmds = ""                      # commands recorded by the sniffer, "" for all
+sniffQueueSize = 10000              # events waiting to be written before new ones are dropped
+gatewayListen = "tcp://127.0.0.1:8485"  # address aquagateway.py listens on, tcp://host:port or unix:path
+gatewayBufferSize = 65536           # bytes waiting to be sent to a gateway client before it is dropped
 
+# controller simulator
+simDevice = "/tmp/aqualinkSim"      # link to the simulator pseudo-terminal, set RS485Device to this
+simPanels = {'\x09': 10.0}          # panel addresses polled by the simulator and polls per second
+simAckTimeout = 0.05                # time the simulator waits for an ack
+simNoiseRate = 0.0                  # fraction of messages preceded by noise
+simBadChecksumRate = 0.0            # fraction of messages sent with a bad checksum